@@ -1,4 +1,4 @@
-import pickle
+import cube_image_transform as cit
 
 colors = {}
 
@@ -24,17 +24,8 @@ colors_rgb["red"] = "#9b3241"
 colors_rgb["blue"] = "#2f91b6"
 
 
-with open("colors2.pickle", "wb") as f:
-    pickle.dump(colors, f)
-with open("colors_rgb2.pickle", "wb") as f:
-    pickle.dump(colors_rgb, f)
-    
-with open('colors2.pickle', 'rb') as f:
-    b = pickle.load(f)
+cit.save_palette_file("palette2.json", colors_rgb, colors)
 
-print(b==colors)
+b = cit.load_palette_file("palette2.json")
 
-with open('colors_rgb2.pickle', 'rb') as f:
-    b = pickle.load(f)
-    
-print(b==colors_rgb)
\ No newline at end of file
+print(dict(zip(b.names, b.counts.tolist()))==colors)
@@ -0,0 +1,193 @@
+import argparse
+import glob
+from os import path
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import cv2
+import cube_image_transform as cit
+import cube_mc
+
+# Batch version of display_all for a whole gallery of images.
+# The original images and the palette are put in shared memory
+# once, the sequential and permuted variants of every image run
+# as separate tasks in a process pool, and the comparison figures
+# are written to the output folder without opening any windows.
+#
+# Example:
+#     python cube_batch.py images/*.jpg --size 40 30 -m 13 --adjust
+
+variants = ("sequential", "permuted")
+
+##########################################
+############# SHARED MEMORY ##############
+##########################################
+
+def share_array(array):
+    # Copies the array to a new shared memory block and returns
+    # the block with the spec that the workers use to attach to it
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def attach_array(spec):
+    # Attaches to the shared array described by the spec. The
+    # returned block has to be kept alive while the array is used.
+
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+    return shm, array
+
+##########################################
+############# WORKER METHODS #############
+##########################################
+
+def transform_variant(image_spec, palette_spec, counts_spec, variant, imagesize=(40, 30), m=1,
+                      scarcity_weight=0.9, adjust=False, nsteps=100000, seed=None):
+    # Computes one variant of display_all for a shared image:
+    # the scarce transform and its Monte Carlo refinement
+
+    image_shm, image_original = attach_array(image_spec)
+    palette_shm, palette = attach_array(palette_spec)
+    counts_shm, counts = attach_array(counts_spec)
+
+    try:
+        image = cv2.resize(image_original, imagesize)
+        scarce_palette = cit.ScarcePalette(palette, counts).multiply(m=m)
+    finally:
+        del image_original, palette, counts
+        image_shm.close()
+        palette_shm.close()
+        counts_shm.close()
+
+    if variant == "sequential":
+        image_scarce = cit.transform_image_scarce(image, scarce_palette, adjust=adjust,
+                                                  scarcity_weight=scarcity_weight)
+    elif variant == "permuted":
+        image_scarce = cit.transform_image_scarce_permute(image, scarce_palette, adjust=adjust,
+                                                          scarcity_weight=scarcity_weight, seed=seed)
+    else:
+        raise ValueError(f"Unknown variant: {variant}")
+
+    image_mc = cube_mc.transform_mc_batched(np.copy(image_scarce), image, steps=nsteps,
+                                            adjust=adjust, seed=seed)
+
+    return image, image_scarce, image_mc
+
+def render_comparison(results, filename):
+    # Writes the five panel figure of display_all for one image
+
+    image, image_scarce, image_scarce_mc = results["sequential"]
+    _, image_scarce_permute, image_scarce_permute_mc = results["permuted"]
+
+    cit.save_comparison([image, image_scarce, image_scarce_mc,
+                         image_scarce_permute, image_scarce_permute_mc], filename)
+
+    return filename
+
+##########################################
+############# BATCH METHODS ##############
+##########################################
+
+def run_batch(image_paths, scarce_palette, imagesize=(40, 30), m=1, scarcity_weight=0.9,
+              adjust=False, nsteps=100000, seed=None, outdir="images/transforms", workers=None):
+    # Transforms all the images in a process pool and writes the
+    # comparison figures to outdir. Returns the computed variants
+    # as a dictionary {name: {variant: (image, transform, transform_mc)}}.
+
+    os.makedirs(outdir, exist_ok=True)
+
+    names = [path.splitext(path.basename(image_path))[0] for image_path in image_paths]
+    seeds = np.random.SeedSequence(seed).generate_state(len(image_paths)*len(variants))
+
+    blocks = []
+    try:
+        palette_shm, palette_spec = share_array(np.array(scarce_palette[0]))
+        blocks.append(palette_shm)
+        counts_shm, counts_spec = share_array(np.array(scarce_palette[1]))
+        blocks.append(counts_shm)
+
+        image_specs = []
+        for image_path in image_paths:
+            image_shm, image_spec = share_array(cit.read_image(image_path))
+            blocks.append(image_shm)
+            image_specs.append(image_spec)
+
+        params = dict(imagesize=imagesize, m=m, scarcity_weight=scarcity_weight,
+                      adjust=adjust, nsteps=nsteps)
+        results = {name: {} for name in names}
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for i, (name, image_spec) in enumerate(zip(names, image_specs)):
+                for j, variant in enumerate(variants):
+                    future = pool.submit(transform_variant, image_spec, palette_spec, counts_spec,
+                                         variant, seed=int(seeds[i*len(variants)+j]), **params)
+                    futures[future] = (name, variant)
+
+            # An image is rendered as soon as all of its variants are done
+            renders = []
+            for future in as_completed(futures):
+                name, variant = futures[future]
+                results[name][variant] = future.result()
+                if len(results[name]) == len(variants):
+                    filename = path.join(outdir, name+".jpg")
+                    renders.append(pool.submit(render_comparison, results[name], filename))
+
+            for future in renders:
+                future.result()
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return results
+
+def load_palette(name):
+    # Palettes available from the command line, or a palette file
+
+    if name.endswith(".json"):
+        return cit.load_palette_file(name)
+    elif name == "1":
+        return cit.load_my_palette()
+    elif name == "2":
+        return cit.load_my_palette2()
+    elif name == "2eq":
+        return cit.load_my_palette2(equal=True)
+
+    raise ValueError(f"Unknown palette: {name}")
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Transform a batch of images into cube paintings.")
+    parser.add_argument("images", nargs="*", help="image files, all of images/*.jpg by default")
+    parser.add_argument("--palette", default="2", help="1, 2, 2eq or the path of a palette file")
+    parser.add_argument("--size", type=int, nargs=2, default=(40, 30), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("-m", type=int, default=1, help="palette multiplication factor")
+    parser.add_argument("--scarcity-weight", type=float, default=0.9)
+    parser.add_argument("--adjust", action="store_true")
+    parser.add_argument("--nsteps", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--outdir", default="images/transforms")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    image_paths = args.images or sorted(glob.glob("images/*.jpg"))
+    scarce_palette = load_palette(args.palette)
+
+    run_batch(image_paths, scarce_palette, imagesize=tuple(args.size), m=args.m,
+              scarcity_weight=args.scarcity_weight, adjust=args.adjust, nsteps=args.nsteps,
+              seed=args.seed, outdir=args.outdir, workers=args.workers)
+
+    for image_path in image_paths:
+        print(image_path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import argparse
+import glob
+import json
+import platform
+import time
+import tracemalloc
+from os import path
+
+import numpy as np
+import cv2
+import cube_image_transform as cit
+import cube_mc
+
+# Benchmarks of the CubePainting transforms. Every transform is run
+# on seeded synthetic images and on the bundled images at several
+# grid sizes, and the throughput and peak memory are written to
+# a JSON file that can be compared with the results of another run.
+#
+# Example:
+#     python cube_benchmark.py --sizes 40x30 120x90 --output bench.json
+#     python cube_benchmark.py --compare bench.json
+
+default_sizes = ((40, 30), (120, 90), (400, 300))
+
+##########################################
+############# INPUT METHODS ##############
+##########################################
+
+def synthetic_image(size, seed=0):
+    # Smooth random image, so that the transforms see gradients
+    # and edges as in a painting rather than pure noise
+
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+
+    return cv2.resize(coarse, size, interpolation=cv2.INTER_CUBIC)
+
+def benchmark_inputs(sizes, image_paths, seed=0):
+    # Yields (name, size, image) for all inputs and sizes
+
+    for size in sizes:
+        yield "synthetic", size, synthetic_image(size, seed=seed)
+        for image_path in image_paths:
+            name = path.splitext(path.basename(image_path))[0]
+            yield name, size, cv2.resize(cit.read_image(image_path), size)
+
+def palette_for(image, scarce_palette):
+    # Multiplies the palette so that it has enough cubes for the image
+
+    npixels = image.shape[0]*image.shape[1]
+    m = int(np.ceil(npixels/sum(scarce_palette[1])))
+
+    return cit.multiply_palette(scarce_palette, m=m)
+
+##########################################
+############# BENCHMARK CASES ############
+##########################################
+
+# Every case takes the image, the palette and the settings and
+# returns a function to be timed together with the amount of work
+# it does, measured in pixels or in MC proposals.
+
+def case_transform_image(image, scarce_palette, settings):
+    work = image.shape[0]*image.shape[1]
+
+    def run():
+        cit.transform_image(image, scarce_palette[0])
+
+    return run, work, "pixels"
+
+def case_transform_image_scarce(image, scarce_palette, settings):
+    work = image.shape[0]*image.shape[1]
+
+    def run():
+        cit.transform_image_scarce(image, palette_for(image, scarce_palette),
+                                   scarcity_weight=settings["scarcity_weight"])
+
+    return run, work, "pixels"
+
+def case_transform_image_scarce_permute(image, scarce_palette, settings):
+    work = image.shape[0]*image.shape[1]
+
+    def run():
+        cit.transform_image_scarce_permute(image, palette_for(image, scarce_palette),
+                                           scarcity_weight=settings["scarcity_weight"],
+                                           seed=settings["seed"])
+
+    return run, work, "pixels"
+
+def case_apply_permuted(image, scarce_palette, settings):
+    work = image.shape[0]*image.shape[1]
+    palette = scarce_palette[0]
+
+    def run():
+        cit.apply_permuted(np.copy(image), lambda color: cit.choose_color(color, palette))
+
+    return run, work, "pixels"
+
+def mc_start(image, scarce_palette, settings):
+    return cit.transform_image_scarce(image, palette_for(image, scarce_palette),
+                                      scarcity_weight=settings["scarcity_weight"])
+
+def case_transform_mc(image, scarce_palette, settings):
+    start = mc_start(image, scarce_palette, settings)
+    steps = settings["mc_steps"]
+
+    def run():
+        np.random.seed(settings["seed"])
+        cit.transform_mc(np.copy(start), image, steps=steps)
+
+    return run, steps, "proposals"
+
+def case_transform_mc_batched(image, scarce_palette, settings):
+    start = mc_start(image, scarce_palette, settings)
+    steps = settings["mc_steps"]
+
+    def run():
+        cube_mc.transform_mc_batched(np.copy(start), image, steps=steps, seed=settings["seed"],
+                                     backend="numpy")
+
+    return run, steps, "proposals"
+
+def case_transform_mc_numba(image, scarce_palette, settings):
+    start = mc_start(image, scarce_palette, settings)
+    steps = settings["mc_steps"]
+
+    # Compile the kernel before it is timed
+    cube_mc.transform_mc_batched(np.copy(start), image, steps=1, backend="numba")
+
+    def run():
+        cube_mc.transform_mc_batched(np.copy(start), image, steps=steps, seed=settings["seed"],
+                                     backend="numba")
+
+    return run, steps, "proposals"
+
+cases = {"transform_image": case_transform_image,
+         "transform_image_scarce": case_transform_image_scarce,
+         "transform_image_scarce_permute": case_transform_image_scarce_permute,
+         "apply_permuted": case_apply_permuted,
+         "transform_mc": case_transform_mc,
+         "transform_mc_batched": case_transform_mc_batched}
+
+if cube_mc.numba is not None:
+    cases["transform_mc_numba"] = case_transform_mc_numba
+
+##########################################
+############# RUN METHODS ################
+##########################################
+
+def measure(run, repeat=1):
+    # Returns the best wall time of repeat runs and the peak
+    # memory of an extra run traced by tracemalloc
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter()-start)
+
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak
+
+def run_benchmarks(scarce_palette, sizes=default_sizes, image_paths=(), case_names=None,
+                   repeat=1, mc_steps=20000, scarcity_weight=0.9, seed=0, verbose=True):
+    # Runs the chosen cases on every input and returns the list of results
+
+    settings = dict(mc_steps=mc_steps, scarcity_weight=scarcity_weight, seed=seed)
+    case_names = case_names or list(cases)
+
+    results = []
+    for name, size, image in benchmark_inputs(sizes, image_paths, seed=seed):
+        for case_name in case_names:
+            run, work, unit = cases[case_name](image, scarce_palette, settings)
+            seconds, peak = measure(run, repeat=repeat)
+
+            result = {"case": case_name, "input": name, "size": list(size), "unit": unit,
+                      "work": work, "seconds": seconds, "throughput": work/seconds,
+                      "peak_bytes": peak}
+            results.append(result)
+
+            if verbose:
+                print(f"{case_name:32s} {name:10s} {size[0]:4d}x{size[1]:<4d} "
+                      f"{result['throughput']:12.1f} {unit}/s {peak/2**20:9.2f} MiB")
+
+    return results
+
+def result_key(result):
+    return (result["case"], result["input"], tuple(result["size"]))
+
+def compare_results(results, reference):
+    # Prints the throughput of the results relative to the reference run
+
+    reference = {result_key(result): result for result in reference}
+
+    for result in results:
+        ref = reference.get(result_key(result))
+        if ref is None:
+            continue
+        speedup = result["throughput"]/ref["throughput"]
+        memory = result["peak_bytes"]/max(ref["peak_bytes"], 1)
+        print(f"{result['case']:32s} {result['input']:10s} {result['size'][0]:4d}x{result['size'][1]:<4d} "
+              f"speed x{speedup:6.2f}  memory x{memory:6.2f}")
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the CubePainting transforms.")
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=default_sizes,
+                        help="grid sizes as WIDTHxHEIGHT")
+    parser.add_argument("--images", nargs="*", default=None,
+                        help="bundled images to use, all of images/*.jpg by default")
+    parser.add_argument("--synthetic-only", action="store_true")
+    parser.add_argument("--cases", nargs="+", choices=list(cases), default=None)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--mc-steps", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON file to store the results in")
+    parser.add_argument("--compare", default=None, help="JSON file of an earlier run")
+    args = parser.parse_args(argv)
+
+    if args.synthetic_only:
+        image_paths = []
+    elif args.images is None:
+        image_paths = sorted(glob.glob("images/*.jpg"))
+    else:
+        image_paths = args.images
+
+    results = run_benchmarks(cit.load_my_palette2(), sizes=args.sizes, image_paths=image_paths,
+                             case_names=args.cases, repeat=args.repeat, mc_steps=args.mc_steps,
+                             seed=args.seed)
+
+    if args.output is not None:
+        report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "python": platform.python_version(), "numpy": np.__version__,
+                  "opencv": cv2.__version__, "machine": platform.machine(),
+                  "settings": {"repeat": args.repeat, "mc_steps": args.mc_steps, "seed": args.seed},
+                  "results": results}
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as handle:
+            reference = json.load(handle)["results"]
+        compare_results(results, reference)
+
+if __name__ == "__main__":
+    main()
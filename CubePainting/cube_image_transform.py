@@ -3,9 +3,19 @@ import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 from os import path
+import os
 import pickle
+import hashlib
+import json
 from matplotlib.colors import ListedColormap
 
+# Numba is optional. Without it the scarce color selection
+# runs on NumPy arrays, one pixel at a time.
+try:
+    import numba
+except ImportError:
+    numba = None
+
 # The weights used in the color distance measurements.
 # This was done in a rather imprecise way. If I wanted
 # to recreate the painting, I would probably use more
@@ -17,25 +27,52 @@ weights2 = (3, 4, 2)
 ############# INPUT COLOR AND IMAGE METHODS ############# 
 #########################################################
 
-def plot_color(color, size=(5, 5)):
+def new_figure(headless=False, figsize=None):
+    # Figure on the pyplot backend, or a headless figure drawn with
+    # the Agg canvas that is only written to a file. The headless
+    # figures are not registered with pyplot, so they also work
+    # without a display and do not have to be closed.
+    
+    if not headless:
+        return plt.figure(figsize=figsize)
+    
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    
+    return fig
+
+def show_figure(fig, filename=None):
+    # Shows the figure, or saves it if a file name is given
+    
+    if filename is None:
+        plt.show()
+    else:
+        fig.savefig(filename)
+
+def plot_color(color, size=(5, 5), filename=None):
     # Plots the color given in RGB coordinates as a big colorful square
     
     c = ListedColormap([tuple(color/255)])
-    fig, ax  = plt.subplots(figsize=size)
+    fig = new_figure(headless=filename is not None, figsize=size)
+    ax = fig.subplots()
     colplot = ax.imshow(np.ones(size), cmap = c)
-    plt.axis('off')
-    plt.show()
+    ax.axis('off')
+    show_figure(fig, filename)
     
     return colplot
 
-def plot_color_comparison(color1, color2, size=(5, 5), adjust=False):
+def plot_color_comparison(color1, color2, size=(5, 5), adjust=False, filename=None):
     # Plots two colors side by side and shows their distance
     
     c1 = ListedColormap([tuple(color1/255)])
     c2 = ListedColormap([tuple(color2/255)])
     dist = rgb_distance(color1, color2, adjust=adjust)
     
-    fig, axs  = plt.subplots(1, 2, figsize=(2*size[0], size[1]))
+    fig = new_figure(headless=filename is not None, figsize=(2*size[0], size[1]))
+    axs = fig.subplots(1, 2)
     colplot1 = axs[0].imshow(np.ones(size), cmap = c1)
     colplot2 = axs[1].imshow(np.ones(size), cmap = c2)
     axs[0].set_xlabel(f"RGB: {tuple(color1)}", fontsize=20, color="white")
@@ -49,9 +86,9 @@ def plot_color_comparison(color1, color2, size=(5, 5), adjust=False):
         axs[i].get_xaxis().set_ticks([])
         axs[i].get_yaxis().set_ticks([])
         
-    plt.suptitle(f"Distance={np.round(dist, 2)}", fontsize=30, color="white")
+    fig.suptitle(f"Distance={np.round(dist, 2)}", fontsize=30, color="white")
     
-    plt.show()
+    show_figure(fig, filename)
 
 def read_image(image_path, resize=False, size=(40, 30)):
     # Creates a numpy array from the image specified by the path
@@ -64,12 +101,13 @@ def read_image(image_path, resize=False, size=(40, 30)):
 
     return image_original
 
-def plot_image(image):
+def plot_image(image, filename=None):
     
-    fig, ax = plt.subplots()
+    fig = new_figure(headless=filename is not None)
+    ax = fig.subplots()
     ax.imshow(image)
     ax.axis("off")
-    plt.show()
+    show_figure(fig, filename)
 
 ###########################################
 ############# PALETTE METHODS #############
@@ -94,63 +132,256 @@ def convert_palette_to_RGB(palette_hex):
     
     return palette_rgb
 
+class ScarcePalette:
+    # Palette with a limited number of cubes of every color. The RGB
+    # codes, the counts and the remaining total are kept in arrays.
+    # Indexing works as for the older (rgb list, counts, [total])
+    # tuple, so scarce_palette[1][i] -= 1 still updates the counts.
+    
+    def __init__(self, rgb, counts, total=None, names=None):
+        
+        self.rgb = np.array(rgb, dtype=np.uint8).reshape(-1, 3)
+        self.counts = np.array(counts, dtype=np.int64)
+        self.names = None if names is None else list(names)
+        
+        if total is None:
+            total = self.counts.sum()
+        self.total = np.array([total], dtype=np.int64).ravel()
+    
+    @classmethod
+    def from_palette(cls, scarce_palette):
+        # Copies a ScarcePalette or converts the older tuple format
+        
+        return cls(scarce_palette[0], scarce_palette[1], scarce_palette[2][0],
+                   names=getattr(scarce_palette, "names", None))
+    
+    def copy(self):
+        # Cheap clone, e.g. instead of calling multiply_palette again
+        
+        return ScarcePalette(self.rgb, self.counts, self.total[0], names=self.names)
+    
+    def content_hash(self):
+        # Hash of the colors and the current counts
+        
+        return palette_hash(self.rgb, self.counts)
+    
+    def __getitem__(self, idx):
+        return (self.rgb, self.counts, self.total)[idx]
+    
+    def __len__(self):
+        return 3
+    
+    def __repr__(self):
+        return f"ScarcePalette(counts={self.counts.tolist()}, total={self.total[0]})"
+    
+    def scarcity_factors(self, scarcity_weight=0.1):
+        # Vectorized scarce_factor for all colors. The colors
+        # that have run out get an infinite factor.
+        
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return scarcity_factors(self.counts, self.total[0], scarcity_weight)
+    
+    def choose(self, dist, scarcity_weight=0.1):
+        # Picks the color with the smallest scarce distance, given
+        # the distances of a pixel to all the palette colors, and
+        # decrements its count. Returns the index of the color.
+        
+        idcs = np.empty(1, dtype=np.intp)
+        choose_scarce_numpy(np.asarray(dist)[None, :], self.counts, self.total, scarcity_weight, idcs)
+        
+        return int(idcs[0])
+    
+    def multiply(self, m=13):
+        
+        return ScarcePalette(self.rgb, m*self.counts, names=self.names)
+
+def scarcity_factors(counts, total, scarcity_weight):
+    # scarce_factor of all colors from their counts, infinite for
+    # the colors that have run out. The caller sets np.errstate.
+    
+    fraction = counts/total
+    factors = 2.0*np.arctanh(scarcity_weight*(1.0-fraction))-1.0
+    
+    return np.where(fraction > 0.0, factors, np.inf)
+
+def choose_scarce_numpy(dist, counts, total, scarcity_weight, idcs):
+    # Chooses the colors of the pixels in order, given the distances
+    # of every pixel to all the palette colors, and decrements the
+    # counts and the total (an array of one element) in place. The
+    # factors change with the total, so they are computed per pixel.
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i in range(len(dist)):
+            scarce_dist = scarcity_factors(counts, total[0], scarcity_weight)*dist[i]
+            
+            # An exhausted color at zero distance gives inf*0=nan,
+            # so it is excluded explicitly
+            scarce_dist[counts <= 0] = np.inf
+            idx = np.argmin(scarce_dist)
+            
+            idcs[i] = idx
+            counts[idx] -= 1
+            total[0] -= 1
+
+def choose_scarce_kernel(dist, counts, total, scarcity_weight, idcs):
+    # Same as choose_scarce_numpy with plain loops over the
+    # preallocated arrays, compiled with numba when it is available.
+    # A nan scarce distance is chosen first, as by np.argmin.
+    
+    ncolors = counts.shape[0]
+    factors = np.empty(ncolors)
+    
+    for i in range(dist.shape[0]):
+        for c in range(ncolors):
+            fraction = counts[c]/total[0]
+            if fraction > 0.0:
+                factors[c] = 2.0*np.arctanh(scarcity_weight*(1.0-fraction))-1.0
+        
+        idx = -1
+        dist_min = np.inf
+        for c in range(ncolors):
+            if counts[c] <= 0:
+                continue
+            scarce_dist = factors[c]*dist[i, c]
+            if scarce_dist != scarce_dist:
+                idx = c
+                break
+            if idx < 0 or scarce_dist < dist_min:
+                idx = c
+                dist_min = scarce_dist
+        
+        idcs[i] = idx
+        counts[idx] -= 1
+        total[0] -= 1
+
+if numba is not None:
+    choose_scarce_kernel = numba.njit(cache=True)(choose_scarce_kernel)
+else:
+    choose_scarce_kernel = choose_scarce_numpy
+
 def create_scarce_palette(palette_hex, color_counts):
     # Takes the dictionary that contains hex codes
-    # for the colors and their counts and converts it to a tuple consisting
-    # of a list of counts and list of rgb codes for colors
+    # for the colors and their counts and converts it to a
+    # ScarcePalette with the rgb codes and the counts of the colors
     
     palette_rgb = convert_palette_to_RGB(palette_hex)
     palette_counts = list(color_counts.values())
-    color_num = [sum(palette_counts)]
     
-    scarce_palette = (palette_rgb, palette_counts, color_num)
+    scarce_palette = ScarcePalette(palette_rgb, palette_counts, names=list(color_counts.keys()))
     
     return scarce_palette
 
-def load_my_palette():
-    # Loads the palette in pickled files
-    # specified by names given in the code
+def palette_hash(rgb, counts=None):
+    # Content hash of the palette colors (and counts), used as the
+    # key of the caches derived from the palette. Only the colors
+    # matter for the lookup tables and color space conversions.
+    
+    key = hashlib.sha1(np.asarray(rgb, dtype=np.uint8).tobytes())
+    if counts is not None:
+        key.update(np.asarray(counts, dtype=np.int64).tobytes())
+    
+    return key.hexdigest()[:16]
+
+#----------------PALETTE FILES----------------#
+
+# A palette file is a small JSON document with the counts and
+# the hex codes of all the colors, e.g.
+#   {"format": "cube-palette", "version": 1, "hash": "...",
+#    "colors": [{"name": "yellow", "hex": "#daca50", "count": 10}, ...]}
+# The hash is the palette_hash of the colors and counts.
+
+palette_format = "cube-palette"
+palette_version = 1
+
+# The palette files are kept next to this module
+palette_dir = path.dirname(path.abspath(__file__))
+
+# Loaded palettes, keyed by the file path and checked against
+# the modification time and size of the file
+palette_cache = {}
+
+def save_palette_file(filename, palette_hex, color_counts):
+    # Writes the palette given by the dictionaries of hex
+    # codes and counts, as used in colors.py, to a palette file
+    
+    scarce_palette = create_scarce_palette(palette_hex, color_counts)
+    
+    header = {"format": palette_format, "version": palette_version,
+              "hash": palette_hash(scarce_palette.rgb, scarce_palette.counts)}
+    colors = [json.dumps({"name": name, "hex": palette_hex[name], "count": int(color_counts[name])})
+              for name in color_counts]
+    
+    # One color per line keeps the file short and easy to edit
+    with open(filename, "w") as handle:
+        handle.write(json.dumps(header)[:-1]+', "colors": [\n  ')
+        handle.write(",\n  ".join(colors))
+        handle.write("\n]}\n")
+
+def read_palette_file(filename):
+    # Reads the palette file without the cache
+    
+    with open(filename) as handle:
+        document = json.load(handle)
+    
+    if document.get("format") != palette_format:
+        raise ValueError(f"{filename} is not a palette file")
+    if document.get("version") != palette_version:
+        raise ValueError(f"Unsupported palette file version: {document.get('version')}")
+    
+    names = [color["name"] for color in document["colors"]]
+    rgb = [convert_hex_to_rgb(color["hex"]) for color in document["colors"]]
+    counts = [color["count"] for color in document["colors"]]
+    
+    scarce_palette = ScarcePalette(rgb, counts, names=names)
+    
+    if document.get("hash", scarce_palette.content_hash()) != scarce_palette.content_hash():
+        raise ValueError(f"The hash of the palette file {filename} does not match its contents")
+    
+    return scarce_palette
+
+def load_palette_file(filename):
+    # Loads the palette file once per process. Every call returns
+    # a fresh copy, so the transforms can use up its counts.
+    
+    filename = path.abspath(filename)
+    stat = os.stat(filename)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    
+    cached = palette_cache.get(filename)
+    if cached is None or cached[0] != stamp:
+        cached = (stamp, read_palette_file(filename))
+        palette_cache[filename] = cached
+    
+    return cached[1].copy()
+
+def convert_pickled_palette(colors_pickle, colors_rgb_pickle, filename):
+    # Converts the older pair of pickled dictionaries to a palette file
     
-    with open("colors.pickle", "rb") as handle:
+    with open(colors_pickle, "rb") as handle:
         my_colors = pickle.load(handle)
-    with open("colors_rgb.pickle", "rb") as handle:
+    with open(colors_rgb_pickle, "rb") as handle:
         my_colors_rgb = pickle.load(handle)
     
-    scrc = create_scarce_palette(my_colors_rgb, my_colors)
+    save_palette_file(filename, my_colors_rgb, my_colors)
+
+def load_my_palette():
+    # Loads the full palette of all the bought cubes
     
-    return scrc
+    return load_palette_file(path.join(palette_dir, "palette_full.json"))
 
 def load_my_palette2(equal=False):
-    # Loads the palette 2 in pickled files
-    # specified by names given in the code
+    # Loads the palette 2, or the palette 2 with
+    # equal counts of all the colors
     
     if equal:
-        with open("colors2eq.pickle", "rb") as handle:
-            my_colors = pickle.load(handle)
-        with open("colors_rgb2eq.pickle", "rb") as handle:
-            my_colors_rgb = pickle.load(handle)   
-    elif not equal:
-        with open("colors2.pickle", "rb") as handle:
-            my_colors = pickle.load(handle)
-        with open("colors_rgb2.pickle", "rb") as handle:
-            my_colors_rgb = pickle.load(handle)
-    
+        return load_palette_file(path.join(palette_dir, "palette2eq.json"))
     
-    scrc = create_scarce_palette(my_colors_rgb, my_colors)
-    
-    return scrc
+    return load_palette_file(path.join(palette_dir, "palette2.json"))
 
 def multiply_palette(scarce_palette, m=13):
     # Multiply number of colors in palette by a factor m
     
-    scarce_palette_m_counts = np.copy(scarce_palette[1])
-    
-    for i in range(len(scarce_palette[1])):
-        scarce_palette_m_counts[i] = m*scarce_palette[1][i]
-
-    scarce_palette_m = (scarce_palette[0], scarce_palette_m_counts,  [sum(scarce_palette_m_counts)])
-    
-    return scarce_palette_m
+    return ScarcePalette.from_palette(scarce_palette).multiply(m=m)
 
 ############################################
 ############# TRANSFORM METHODS ############
@@ -175,6 +406,17 @@ def rgb_distance(color1, color2, adjust=False):
         
     return dist
 
+def scarce_factor(fraction, scarcity_weight=0.1):
+    # Factor that multiplies the color distance. It grows as
+    # the fraction of the remaining cubes of the color drops.
+    
+    if fraction > 0.0:
+        scarcity_factor = 2.0*np.arctanh(scarcity_weight*(1.0-fraction))-1.0
+    else:
+        scarcity_factor = np.inf
+    
+    return scarcity_factor
+
 def rgb_scarce_distance(color1, color2, fraction, scarcity_weight=0.1, adjust=False):
     # The distance between colors is calculated with taking into the account
     # the fraction of remaining colors. The influence of the fraction on
@@ -183,10 +425,7 @@ def rgb_scarce_distance(color1, color2, fraction, scarcity_weight=0.1, adjust=Fa
     col1norm = color1/255
     col2norm = color2/255
     
-    if fraction > 0.0:
-        scarcity_factor = 2.0*np.arctanh(scarcity_weight*(1.0-fraction))-1.0
-    else:
-        scarcity_factor = np.inf
+    scarcity_factor = scarce_factor(fraction, scarcity_weight=scarcity_weight)
     
     if adjust:
         Rmean = (int(color1[0])+int(color2[0]))/2
@@ -199,12 +438,198 @@ def rgb_scarce_distance(color1, color2, fraction, scarcity_weight=0.1, adjust=Fa
         
     return dist
 
+#----------------BATCHED DISTANCES----------------#
+
+def rgb_distance_array(colors1, colors2, adjust=False):
+    # Vectorized version of rgb_distance. The colors are arrays
+    # with RGB values on the last axis and the remaining axes
+    # are broadcast against each other, so passing pixels with
+    # shape (n, 1, 3) and a palette with shape (1, k, 3) gives
+    # the full (n, k) distance matrix. The channel terms are summed
+    # in the same order as in rgb_distance to get identical values.
+    
+    colors1 = np.asarray(colors1)
+    colors2 = np.asarray(colors2)
+    
+    diff2 = (colors1/255-colors2/255)**2
+    
+    if adjust:
+        Rmean = (colors1[..., 0].astype(np.int64)+colors2[..., 0].astype(np.int64))/2
+        w1 = np.array(weights1, dtype=float)
+        w2 = np.array(weights2, dtype=float)
+        w = np.where((Rmean < 128)[..., None], w1, w2)
+        diff2 = w*diff2
+    
+    dist = np.sqrt(diff2[..., 0]+diff2[..., 1]+diff2[..., 2])
+    
+    return dist
+
+def palette_distance_matrix(pixels, palette, adjust=False, metric=None):
+    # The (n, k) matrix of distances between n pixels and k palette
+    # colors. Without a metric the rgb_distance is used as before,
+    # otherwise both color sets are converted once for the metric.
+    
+    pixels = np.asarray(pixels)
+    palette = np.asarray(palette)
+    
+    if metric is None:
+        return rgb_distance_array(pixels[:, None, :], palette[None, :, :], adjust=adjust)
+    
+    pixels_conv = convert_colors(pixels, metric)
+    palette_conv = convert_colors(palette, metric)
+    
+    return converted_distance_array(pixels_conv[:, None, :], palette_conv[None, :, :], metric)
+
+def quantize_indices(pixels, palette, adjust=False, chunk_size=65536, metric=None):
+    # Finds the index of the closest palette color for every pixel.
+    # Pixels are given as an (n, 3) array and processed in chunks
+    # so that the (chunk, k) distance matrix stays bounded in memory.
+    # Ties go to the first palette color, as in choose_color.
+    
+    pixels = np.asarray(pixels)
+    palette = np.asarray(palette)
+    
+    idcs = np.empty(len(pixels), dtype=np.intp)
+    
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start+chunk_size]
+        dist = palette_distance_matrix(chunk, palette, adjust=adjust, metric=metric)
+        idcs[start:start+chunk_size] = np.argmin(dist, axis=1)
+    
+    return idcs
+
+#----------------COLOR SPACE DISTANCES----------------#
+
+# Available distance metrics:
+#   "rgb"       - the plain rgb_distance
+#   "weighted"  - the rgb_distance with adjust=True
+#   "cie76"     - Euclidean distance in CIELAB (Delta E 1976)
+#   "ciede2000" - the CIEDE2000 color difference
+# The colors are converted to the space of the metric once,
+# and the distance kernels work on the converted arrays.
+# The CIELAB distances are in the units of Delta E, which
+# are about a hundred times larger than the RGB distances.
+
+distance_metrics = ("rgb", "weighted", "cie76", "ciede2000")
+
+# sRGB (D65) to XYZ conversion matrix and the D65 white point
+rgb_to_xyz_matrix = np.array([[0.4124564, 0.3575761, 0.1804375],
+                              [0.2126729, 0.7151522, 0.0721750],
+                              [0.0193339, 0.1191920, 0.9503041]])
+white_d65 = np.array([0.95047, 1.0, 1.08883])
+
+def rgb_to_lab(colors):
+    # Converts an array of 8-bit sRGB colors to CIELAB
+    
+    c = np.asarray(colors)/255
+    linear = np.where(c <= 0.04045, c/12.92, ((c+0.055)/1.055)**2.4)
+    xyz = (linear @ rgb_to_xyz_matrix.T)/white_d65
+    
+    delta = 6/29
+    f = np.where(xyz > delta**3, np.cbrt(xyz), xyz/(3*delta**2)+4/29)
+    
+    L = 116*f[..., 1]-16
+    a = 500*(f[..., 0]-f[..., 1])
+    b = 200*(f[..., 1]-f[..., 2])
+    
+    return np.stack((L, a, b), axis=-1)
+
+def delta_e76(lab1, lab2):
+    
+    return np.sqrt(np.sum((lab1-lab2)**2, axis=-1))
+
+def delta_e2000(lab1, lab2):
+    # Vectorized CIEDE2000 color difference (Sharma et al. 2005)
+    
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+    
+    C1 = np.hypot(a1, b1)
+    C2 = np.hypot(a2, b2)
+    C7 = ((C1+C2)/2)**7
+    G = 0.5*(1-np.sqrt(C7/(C7+25.0**7)))
+    
+    a1p = (1+G)*a1
+    a2p = (1+G)*a2
+    C1p = np.hypot(a1p, b1)
+    C2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+    
+    dLp = L2-L1
+    dCp = C2p-C1p
+    
+    # Hue difference, zero when one of the colors is achromatic
+    dhp = h2p-h1p
+    dhp = np.where(dhp > 180, dhp-360, dhp)
+    dhp = np.where(dhp < -180, dhp+360, dhp)
+    dhp = np.where(C1p*C2p == 0, 0.0, dhp)
+    dHp = 2*np.sqrt(C1p*C2p)*np.sin(np.radians(dhp)/2)
+    
+    Lp_mean = (L1+L2)/2
+    Cp_mean = (C1p+C2p)/2
+    
+    hp_sum = h1p+h2p
+    hp_mean = np.where(np.abs(h1p-h2p) > 180,
+                       np.where(hp_sum < 360, (hp_sum+360)/2, (hp_sum-360)/2),
+                       hp_sum/2)
+    hp_mean = np.where(C1p*C2p == 0, hp_sum, hp_mean)
+    
+    T = (1-0.17*np.cos(np.radians(hp_mean-30))+0.24*np.cos(np.radians(2*hp_mean))
+         +0.32*np.cos(np.radians(3*hp_mean+6))-0.20*np.cos(np.radians(4*hp_mean-63)))
+    
+    d_theta = 30*np.exp(-((hp_mean-275)/25)**2)
+    Cp7 = Cp_mean**7
+    R_C = 2*np.sqrt(Cp7/(Cp7+25.0**7))
+    S_L = 1+0.015*(Lp_mean-50)**2/np.sqrt(20+(Lp_mean-50)**2)
+    S_C = 1+0.045*Cp_mean
+    S_H = 1+0.015*Cp_mean*T
+    R_T = -np.sin(np.radians(2*d_theta))*R_C
+    
+    dE = np.sqrt((dLp/S_L)**2+(dCp/S_C)**2+(dHp/S_H)**2+R_T*(dCp/S_C)*(dHp/S_H))
+    
+    return dE
+
+def convert_colors(colors, metric):
+    # Converts the colors to the space in which the metric works
+    
+    if metric in ("rgb", "weighted"):
+        return np.asarray(colors)
+    elif metric in ("cie76", "ciede2000"):
+        return rgb_to_lab(colors)
+    
+    raise ValueError(f"Unknown distance metric: {metric}")
+
+def converted_distance_array(colors1, colors2, metric):
+    # Distance between colors already converted by convert_colors,
+    # broadcast in the same way as in rgb_distance_array
+    
+    if metric == "rgb":
+        return rgb_distance_array(colors1, colors2, adjust=False)
+    elif metric == "weighted":
+        return rgb_distance_array(colors1, colors2, adjust=True)
+    elif metric == "cie76":
+        return delta_e76(colors1, colors2)
+    elif metric == "ciede2000":
+        return delta_e2000(colors1, colors2)
+    
+    raise ValueError(f"Unknown distance metric: {metric}")
+
+def color_distance(color1, color2, metric="rgb"):
+    # Distance between two colors using the chosen metric
+    
+    return converted_distance_array(convert_colors(color1, metric), convert_colors(color2, metric), metric)
+
 #----------------BASIC TRANSFORM----------------#
 
-def choose_color(color_inp, color_palette, adjust=False):
+def choose_color(color_inp, color_palette, adjust=False, metric=None):
     # Picks a color from the palette defined by the available 
     # cubes by searching for the cube with the smallest color distance.
     
+    if metric is not None:
+        idx = np.argmin(palette_distance_matrix(np.asarray(color_inp)[None, :], color_palette, metric=metric)[0])
+        return color_palette[idx]
+    
     color_min = color_palette[0]
     dist_min = rgb_distance(color_inp, color_min, adjust=adjust)
     
@@ -216,27 +641,283 @@ def choose_color(color_inp, color_palette, adjust=False):
     
     return color_min
 
-def transform_image(image, color_palette, adjust=False):
+def transform_image(image, color_palette, adjust=False, chunk_size=65536, metric=None):
     # Represents the image using the pixels closest
-    # to the chosen palette
+    # to the chosen palette. The nearest colors are found
+    # with the batched quantization engine, which gives
+    # the same result as calling choose_color per pixel.
     
     xdim, ydim, znum = image.shape
-    image_transform = np.copy(image)
+    palette = np.array(color_palette)
+    
+    # The per-pixel loop always measured the plain distance,
+    # so adjust is not passed on to keep the output unchanged
+    idcs = quantize_indices(image.reshape(xdim*ydim, znum), palette,
+                            adjust=False, chunk_size=chunk_size, metric=metric)
+    image_transform = palette[idcs].astype(image.dtype).reshape(xdim, ydim, znum)
+    
+    return image_transform
+
+#----------------LOOKUP TABLE TRANSFORM----------------#
+
+def palette_lut_key(color_palette, adjust=False, bits=8):
+    # Key that identifies the lookup table for a given palette.
+    # It depends on the palette contents, the distance type
+    # and the number of bits kept per channel.
+    
+    key = hashlib.sha1(palette_hash(color_palette).encode())
+    key.update(f"adjust={bool(adjust)};bits={bits}".encode())
+    
+    return key.hexdigest()[:16]
+
+def build_palette_lut(color_palette, adjust=False, bits=8, chunk_size=65536):
+    # Builds the table of the closest palette color index for every
+    # possible RGB input. With reduced bits, each table entry stands
+    # for a block of colors and is computed from the block center.
+    
+    palette = np.asarray(color_palette)
+    
+    if len(palette) > 256:
+        raise Exception("The lookup table supports at most 256 colors")
+    if not 1 <= bits <= 8:
+        raise Exception("The number of bits per channel has to be between 1 and 8")
+    
+    levels = 2**bits
+    shift = 8-bits
+    values = (np.arange(levels) << shift)+((1 << shift) >> 1)
     
+    r, g, b = np.meshgrid(values, values, values, indexing="ij")
+    pixels = np.stack((r.ravel(), g.ravel(), b.ravel()), axis=1).astype(np.uint8)
+    
+    lut = quantize_indices(pixels, palette, adjust=adjust, chunk_size=chunk_size)
+    lut = lut.astype(np.uint8).reshape(levels, levels, levels)
+    
+    return lut
+
+def load_palette_lut(color_palette, adjust=False, bits=8, cache_dir=palette_dir):
+    # Loads the lookup table from the cache directory, by default
+    # next to the palette files, or builds and saves it if it does
+    # not exist yet. The table is memory mapped, so only the entries
+    # used by the images are read.
+    
+    name = "palette_lut_"+palette_lut_key(color_palette, adjust=adjust, bits=bits)+".npy"
+    lut_path = path.join(cache_dir, name)
+    
+    if not path.exists(lut_path):
+        lut = build_palette_lut(color_palette, adjust=adjust, bits=bits)
+        
+        # Write to a temporary file first so that other processes
+        # never see a partially written table
+        tmp_path = lut_path+f".{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as handle:
+            np.save(handle, lut)
+        os.replace(tmp_path, lut_path)
+    
+    return np.load(lut_path, mmap_mode="r")
 
-    for i in range(xdim):
-        for j in range(ydim):
-            color = np.zeros(znum)
-            color = choose_color(image[i, j], color_palette, adjust=False)
-            image_transform[i, j] = color
+def transform_image_lut(image, color_palette, adjust=False, bits=8, lut=None, cache_dir=palette_dir):
+    # Transforms the image using the precomputed lookup table.
+    # The image can have any leading shape, so a stack of images
+    # with the same size is transformed in a single indexing step.
+    
+    palette = np.asarray(color_palette)
+    
+    if lut is None:
+        lut = load_palette_lut(palette, adjust=adjust, bits=bits, cache_dir=cache_dir)
+    
+    shift = 8-bits
+    image = np.asarray(image)
+    idcs = lut[image[..., 0] >> shift, image[..., 1] >> shift, image[..., 2] >> shift]
+    image_transform = palette[idcs].astype(image.dtype)
+    
+    return image_transform
+
+def transform_images_lut(images, color_palette, adjust=False, bits=8, cache_dir=palette_dir):
+    # Transforms a list of images with a single shared lookup table
+    
+    lut = load_palette_lut(color_palette, adjust=adjust, bits=bits, cache_dir=cache_dir)
+    
+    images_transform = [transform_image_lut(image, color_palette, adjust=adjust, bits=bits, lut=lut)
+                        for image in images]
+    
+    return images_transform
+
+#----------------TILED TRANSFORM----------------#
+
+def raw_image_rows(image_path):
+    # Memory maps an uncompressed 8-bit RGB image (e.g. PPM, BMP or
+    # an uncompressed TIFF) read with PIL, which only parses the header.
+    # Returns None if the pixels are not stored as plain rows.
+    
+    with Image.open(image_path) as im:
+        mode, (width, height), tiles = im.mode, im.size, list(im.tile)
+    
+    if mode != "RGB" or not tiles:
+        return None
+    
+    layouts = set()
+    for tile in tiles:
+        args = tile[3] if isinstance(tile[3], tuple) else (tile[3],)
+        args = (tuple(args)+("", 0, 1)[len(args):])[:3]
+        layouts.add((tile[0],)+args+(tile[1][0], tile[1][2]))
+    if len(layouts) != 1:
+        return None
+    
+    codec, rawmode, stride, orientation, left, right = layouts.pop()
+    if codec != "raw" or rawmode not in ("RGB", "BGR") or orientation not in (1, -1):
+        return None
+    if (left, right) != (0, width):
+        return None
+    stride = stride or 3*width
+    
+    # The strips of the image have to follow each other in the file
+    offset = tiles[0][2]
+    for tile in tiles:
+        if orientation == 1 and tile[2] != offset+tile[1][1]*stride:
+            return None
+    if orientation == -1 and len(tiles) != 1:
+        return None
+    
+    data = np.memmap(image_path, dtype=np.uint8, mode="r", offset=offset,
+                     shape=(stride*(height-1)+3*width,))
+    rows = np.lib.stride_tricks.as_strided(data, shape=(height, width, 3), strides=(stride, 3, 1),
+                                           writeable=False)
+    
+    if orientation == -1:
+        rows = rows[::-1]
+    if rawmode == "BGR":
+        rows = rows[:, :, ::-1]
+    
+    return rows
+
+def load_image_rows(image_path):
+    # Opens the image for the tiled transform without reading the
+    # pixels. Images stored as RGB .npy arrays and uncompressed images
+    # are memory mapped, so only the rows that are used get read.
+    # Compressed images (JPEG, PNG, ...) can only be decoded whole,
+    # so they have to be converted first, or read with read_image
+    # and passed as an array if they fit in memory.
+    
+    if image_path.endswith(".npy"):
+        return np.load(image_path, mmap_mode="r")
+    
+    rows = raw_image_rows(image_path)
+    if rows is None:
+        raise Exception(f"The image {image_path} cannot be read in strips, "
+                        "convert it to .npy or an uncompressed format first")
+    
+    return rows
+
+def resize_coefficients(n_in, n_out, clamp):
+    # Source indices and fixed point weights of bilinear resizing
+    # computed in the same way as cv2.resize: the sampling positions
+    # in float32 and the weights rounded to 11 bits. Along the rows
+    # the positions outside the image are clamped to the edge pixel.
+    
+    scale = 1.0/(n_out/n_in)
+    f = ((np.arange(n_out)+0.5)*scale-0.5).astype(np.float32)
+    idx = np.floor(f).astype(np.intp)
+    f = f-idx.astype(np.float32)
+    
+    if clamp:
+        low = idx < 0
+        f[low] = 0
+        idx[low] = 0
+        high = idx >= n_in-1
+        f[high] = 0
+        idx[high] = n_in-1
+    
+    w0 = np.rint((np.float32(1)-f)*np.float32(2048)).astype(np.int32)
+    w1 = np.rint(f*np.float32(2048)).astype(np.int32)
+    
+    return idx, w0, w1
+
+def resize_strips(image, size, strip_rows=64):
+    # Resizes the uint8 image to size=(width, height) in strips of
+    # output rows and yields (row_start, row_end, strip). Every strip
+    # only reads the two input rows around each of its output rows.
+    # The fixed point arithmetic is that of cv2.resize with the
+    # default bilinear interpolation, so the strips put together are
+    # identical to cv2.resize of the whole image.
+    
+    if image.dtype != np.uint8:
+        raise Exception("The strip-wise resize works on 8-bit images")
+    
+    xdim_in, ydim_in = image.shape[:2]
+    ydim, xdim = size
+    
+    cols, a0, a1 = resize_coefficients(ydim_in, ydim, clamp=True)
+    cols1 = np.minimum(cols+1, ydim_in-1)
+    rows, b0, b1 = resize_coefficients(xdim_in, xdim, clamp=False)
+    rows0 = np.clip(rows, 0, xdim_in-1)
+    rows1 = np.clip(rows+1, 0, xdim_in-1)
+    
+    for row_start in range(0, xdim, strip_rows):
+        row_end = min(row_start+strip_rows, xdim)
+        
+        # Horizontal pass on the input rows needed by the strip
+        needed, inverse = np.unique(np.concatenate((rows0[row_start:row_end], rows1[row_start:row_end])),
+                                    return_inverse=True)
+        source = np.asarray(image[needed]).astype(np.int32)
+        horizontal = source[:, cols]*a0[:, None]+source[:, cols1]*a1[:, None]
+        
+        # Vertical pass with the rounding of the vectorized cv2 code
+        n = row_end-row_start
+        top = horizontal[inverse[:n]] >> 4
+        bottom = horizontal[inverse[n:]] >> 4
+        vertical = ((top*b0[row_start:row_end, None, None]) >> 16)+((bottom*b1[row_start:row_end, None, None]) >> 16)
+        
+        yield row_start, row_end, np.clip((vertical+2) >> 2, 0, 255).astype(np.uint8)
+
+def transform_image_tiled(image, color_palette, size=None, strip_rows=64, out=None,
+                          adjust=False, metric=None):
+    # Tiled version of transform_image for very large images. The image
+    # (an array, a memory map or a path) is optionally resized to
+    # size=(width, height) and quantized in strips of rows, so the
+    # memory used does not grow with the image. With out given as
+    # a .npy path, the result is written to a memory-mapped array.
+    # The result is the same as transform_image of the image resized
+    # with cv2.resize.
+    
+    if isinstance(image, str):
+        image = load_image_rows(image)
+    
+    if size is None:
+        shape = image.shape
+        strips = ((i, min(i+strip_rows, shape[0]), image[i:i+strip_rows])
+                  for i in range(0, shape[0], strip_rows))
+    else:
+        shape = (size[1], size[0], image.shape[2])
+        strips = resize_strips(image, size, strip_rows=strip_rows)
+    
+    if isinstance(out, str):
+        image_transform = np.lib.format.open_memmap(out, mode="w+", dtype=image.dtype, shape=shape)
+    elif out is None:
+        image_transform = np.empty(shape, dtype=image.dtype)
+    else:
+        image_transform = out
+    
+    for row_start, row_end, strip in strips:
+        image_transform[row_start:row_end] = transform_image(np.asarray(strip), color_palette,
+                                                             adjust=adjust, metric=metric)
+    
+    if isinstance(image_transform, np.memmap):
+        image_transform.flush()
     
     return image_transform
 
 #----------------SCARCE TRANSFORM----------------#
 
 
-def choose_color_scarce(color_inp, scarce_palette, scarcity_weight=0.1, adjust=False):
-    # Color is chosen with regard to a scarce_arctanh distance 
+def choose_color_scarce(color_inp, scarce_palette, scarcity_weight=0.1, adjust=False,
+                        metric=None, dist=None):
+    # Color is chosen with regard to a scarce_arctanh distance.
+    # With a metric, the distances to the palette colors can be
+    # passed precomputed in dist, e.g. from palette_distance_matrix.
+    
+    if metric is not None:
+        return choose_color_scarce_metric(color_inp, scarce_palette, scarcity_weight=scarcity_weight,
+                                          metric=metric, dist=dist)
     
     color_min = scarce_palette[0][0]
     dist_min = rgb_scarce_distance(color_inp, color_min, scarce_palette[1][0]/scarce_palette[2][0],
@@ -257,25 +938,71 @@ def choose_color_scarce(color_inp, scarce_palette, scarcity_weight=0.1, adjust=F
     
     return color_min
 
-def transform_image_scarce(image, scarce_palette, scarcity_weight=1.0, adjust=False):
+def choose_color_scarce_metric(color_inp, scarce_palette, scarcity_weight=0.1, metric="rgb", dist=None):
+    # Same as choose_color_scarce, with the distance given by the metric
+    
+    if dist is None:
+        dist = palette_distance_matrix(np.asarray(color_inp)[None, :], scarce_palette[0], metric=metric)[0]
+    
+    idx_min = None
+    dist_min = np.inf
+    
+    for idx in range(len(scarce_palette[0])):
+        fraction = scarce_palette[1][idx]/scarce_palette[2][0]
+        if fraction <= 0.0:
+            continue
+        
+        scarce_dist = scarce_factor(fraction, scarcity_weight=scarcity_weight)*dist[idx]
+        if idx_min is None or scarce_dist < dist_min:
+            idx_min = idx
+            dist_min = scarce_dist
+    
+    # Decrement the color fraction
+    scarce_palette[1][idx_min]-=1
+    scarce_palette[2][0]-=1
+    
+    return scarce_palette[0][idx_min]
+
+def transform_image_scarce(image, scarce_palette, scarcity_weight=1.0, adjust=False, metric=None):
     # Scarce image transform function
     
     xdim, ydim, znum = image.shape
-    image_transform = np.copy(image)
-        
+    
     color_num = scarce_palette[2][0]
     
     if color_num < image.shape[0]*image.shape[1]:
         raise Exception("There is not enough colors to recreate the image")
     
-    for i in range(xdim):
-        for j in range(ydim):
-            color = np.zeros(znum)
-            color = choose_color_scarce(image[i, j], scarce_palette,
-                                        scarcity_weight=scarcity_weight, adjust=False)
-            image_transform[i, j] = color
+    idcs = choose_colors_scarce(image.reshape(xdim*ydim, znum), scarce_palette,
+                                scarcity_weight=scarcity_weight, metric=metric)
+    image_transform = np.array(scarce_palette[0])[idcs].astype(image.dtype)
         
-    return image_transform
+    return image_transform.reshape(xdim, ydim, znum)
+
+def choose_colors_scarce(pixels, scarce_palette, scarcity_weight=1.0, metric=None):
+    # Runs choose_color_scarce on the pixels in order, with the
+    # distances to the palette computed for all pixels at once.
+    # The counts of the palette are decremented as the colors are
+    # used. Returns the indices of the chosen palette colors.
+    
+    palette = scarce_palette
+    if not isinstance(palette, ScarcePalette):
+        palette = ScarcePalette.from_palette(scarce_palette)
+    
+    # The per-pixel version always measured the plain distance
+    dist = palette_distance_matrix(pixels, palette.rgb, adjust=False, metric=metric)
+    
+    idcs = np.empty(len(pixels), dtype=np.intp)
+    choose_scarce_kernel(np.ascontiguousarray(dist, dtype=np.float64), palette.counts, palette.total,
+                         float(scarcity_weight), idcs)
+    
+    # Keep the older tuple palettes up to date
+    if palette is not scarce_palette:
+        for i in range(len(palette.counts)):
+            scarce_palette[1][i] = palette.counts[i]
+        scarce_palette[2][0] = palette.total[0]
+    
+    return idcs
 
 def apply_permuted(matrix, func):
     # Matrix has to be 3x3 and func acts on arrays
@@ -299,14 +1026,15 @@ def apply_permuted(matrix, func):
     
     return matrix
 
-def transform_image_scarce_permute(image, scarce_palette, scarcity_weight=1.0, adjust=False):
+def transform_image_scarce_permute(image, scarce_palette, scarcity_weight=1.0, adjust=False, seed=None,
+                                   metric=None):
     # Scarce image transform function
     
     xdim, ydim, zdim = image.shape
     image_transform = np.copy(image)
     image_transform = image_transform.reshape(xdim*ydim, zdim)
     
-    rng = np.random.default_rng()
+    rng = np.random.default_rng(seed)
     idcs = np.arange(0, xdim*ydim, 1)
     shuffled_idcs = rng.permuted(idcs)
     inverse_idcs = np.argsort(shuffled_idcs)
@@ -318,23 +1046,133 @@ def transform_image_scarce_permute(image, scarce_palette, scarcity_weight=1.0, a
     if color_num < xdim*ydim:
         raise Exception("There is not enough colors to recreate the image")
 
-    for i in range(xdim*ydim):
-         image_transform[i, :] = choose_color_scarce(image_transform[i, :], scarce_palette,
-                                                     scarcity_weight=scarcity_weight, adjust=False)
+    color_idcs = choose_colors_scarce(image_transform, scarce_palette,
+                                      scarcity_weight=scarcity_weight, metric=metric)
+    image_transform = np.array(scarce_palette[0])[color_idcs].astype(image.dtype)
 
     image_transform = image_transform[inverse_idcs, :]
     image_transform = image_transform.reshape(xdim, ydim, zdim)
         
     return image_transform
 
+#----------------OPTIMAL TRANSFORM----------------#
+
+def group_pixels(pixels, bits=None):
+    # Groups the pixels by color. With bits given, the colors are
+    # first reduced to that many bits per channel so that similar
+    # colors share a group. Returns the representative color of
+    # every group, the group label of every pixel and group sizes.
+    
+    pixels = np.asarray(pixels)
+    
+    if bits is not None:
+        shift = 8-bits
+        pixels = (pixels >> shift << shift)+((1 << shift) >> 1)
+    
+    colors, labels, counts = np.unique(pixels, axis=0, return_inverse=True, return_counts=True)
+    
+    return colors, labels.ravel(), counts
+
+def solve_transport(cost, supply, capacity):
+    # Solves the transportation problem of sending supply[u] units
+    # from every source u to sinks with at most capacity[k] units,
+    # minimizing the total cost[u, k] of the flow. The constraint
+    # matrix is totally unimodular, so the simplex solution is integral.
+    
+    from scipy.optimize import linprog
+    from scipy import sparse
+    
+    nsrc, nsnk = cost.shape
+    var = np.arange(nsrc*nsnk).reshape(nsrc, nsnk)
+    
+    A_eq = sparse.csr_matrix((np.ones(nsrc*nsnk), (np.repeat(np.arange(nsrc), nsnk), var.ravel())),
+                             shape=(nsrc, nsrc*nsnk))
+    A_ub = sparse.csr_matrix((np.ones(nsrc*nsnk), (np.tile(np.arange(nsnk), nsrc), var.ravel())),
+                             shape=(nsnk, nsrc*nsnk))
+    
+    result = linprog(cost.ravel(), A_ub=A_ub, b_ub=capacity, A_eq=A_eq, b_eq=supply,
+                     bounds=(0, None), method="highs-ds")
+    
+    if not result.success:
+        raise Exception("The assignment could not be solved: "+result.message)
+    
+    flow = np.rint(result.x).astype(np.int64).reshape(nsrc, nsnk)
+    
+    return flow
+
+def transform_image_optimal(image, scarce_palette, adjust=False, bits=None, metric=None):
+    # Optimal scarce image transform. The cubes are assigned to the
+    # pixels so that the sum of the color distances is the smallest
+    # possible with the available counts, which is the same cost
+    # that the Monte Carlo refinement lowers. Identical pixel colors
+    # are grouped to keep the problem small, and with bits given the
+    # similar colors are grouped as well, which makes the result
+    # approximate but keeps the problem small for large images.
+    
+    xdim, ydim, zdim = image.shape
+    palette = np.array(scarce_palette[0])
+    capacity = np.array(scarce_palette[1])
+    
+    if scarce_palette[2][0] < xdim*ydim:
+        raise Exception("There is not enough colors to recreate the image")
+    
+    pixels = image.reshape(xdim*ydim, zdim)
+    colors, labels, counts = group_pixels(pixels, bits=bits)
+    
+    cost = palette_distance_matrix(colors, palette, adjust=adjust, metric=metric)
+    flow = solve_transport(cost, counts, capacity)
+    
+    # Hand out the colors of every group to its pixels
+    order = np.argsort(labels, kind="stable")
+    idcs = np.repeat(np.tile(np.arange(len(palette)), len(colors)), flow.ravel())
+    
+    image_transform = np.empty_like(pixels)
+    image_transform[order] = palette[idcs]
+    image_transform = image_transform.reshape(xdim, ydim, zdim)
+    
+    # Decrement the used colors as the other scarce transforms do
+    used = flow.sum(axis=0)
+    for i in range(len(palette)):
+        scarce_palette[1][i] -= used[i]
+    scarce_palette[2][0] -= int(used.sum())
+    
+    return image_transform
+
 #----------------MONTE CARLO METHODS----------------#
 
-def swap_mc(image, image_original, adjust=False):
-    # Perform a single random two-pixel swap on the image 
+def swap_mc(image, image_original, adjust=False, metric=None, converted=None):
+    # Perform a single random two-pixel swap on the image.
+    # With a metric, converted holds the image and the original
+    # image converted by convert_colors, and the converted image
+    # is swapped together with the image.
     
     x_src, x_tgt = np.random.randint(0, image.shape[0]), np.random.randint(0, image.shape[0])
     y_src, y_tgt = np.random.randint(0, image.shape[1]), np.random.randint(0, image.shape[1])
     
+    if metric is not None:
+        xs = [x_src, x_tgt, x_src, x_tgt]
+        ys = [y_src, y_tgt, y_src, y_tgt]
+        xs_orig = [x_src, x_tgt, x_tgt, x_src]
+        ys_orig = [y_src, y_tgt, y_tgt, y_src]
+        
+        if converted is None:
+            dist = color_distance(image[xs, ys], image_original[xs_orig, ys_orig], metric)
+            swapped = (image,)
+        else:
+            image_conv, original_conv = converted
+            dist = converted_distance_array(image_conv[xs, ys], original_conv[xs_orig, ys_orig], metric)
+            swapped = (image, image_conv)
+        
+        delta_dist = (dist[2]-dist[0])+(dist[3]-dist[1])
+        
+        if delta_dist <=0:
+            for arr in swapped:
+                col_tgt = np.copy(arr[x_tgt, y_tgt, :])
+                arr[x_tgt, y_tgt, :] = arr[x_src, y_src, :]
+                arr[x_src, y_src, :] = col_tgt
+        
+        return image
+    
     src_dist_init = rgb_distance(image[x_src, y_src, :], image_original[x_src, y_src, :], adjust=adjust)
     tgt_dist_init = rgb_distance(image[x_tgt, y_tgt, :], image_original[x_tgt, y_tgt, :], adjust=adjust)
 
@@ -345,17 +1183,28 @@ def swap_mc(image, image_original, adjust=False):
     
     if delta_dist <=0:
         
-        col_tgt = image[x_tgt, y_tgt, :]
+        col_tgt = np.copy(image[x_tgt, y_tgt, :])
         image[x_tgt, y_tgt, :] = image[x_src, y_src, :]
         image[x_src, y_src, :] = col_tgt
     
     return image
 
-def transform_mc(image, image_original, steps=10000, adjust=False):
-    # Perform the Monte Carlo transform of the image
+def transform_mc(image, image_original, steps=10000, adjust=False, metric=None, backend=None):
+    # Perform the Monte Carlo transform of the image. With a backend
+    # from cube_mc.mc_backends, the swaps are done by the faster
+    # Monte Carlo engine in cube_mc instead of calling swap_mc.
+    
+    if backend is not None:
+        import cube_mc
+        return cube_mc.transform_mc_batched(image, image_original, steps=steps, adjust=adjust,
+                                            metric=metric, backend=backend)
+    
+    converted = None
+    if metric is not None:
+        converted = (np.array(convert_colors(image, metric), dtype=float), convert_colors(image_original, metric))
     
     for i in range(steps):
-        swap_mc(image, image_original, adjust=adjust)
+        swap_mc(image, image_original, adjust=adjust, metric=metric, converted=converted)
 
     return image
 
@@ -363,51 +1212,144 @@ def transform_mc(image, image_original, steps=10000, adjust=False):
 ############# DISPLAY METHOD ###############
 ############################################
 
-def display_all(image_original, scarce_palette, imagesize=(40, 30), m=1,
-                scarcity_weight=0.9, adjust=False, nsteps=100000, save=False, name="test"):
-    # Takes the original image and scarce palette
-    # and displays the original image along the 
-    # transforms and Monte Carlo refinements
+comparison_titles = ("Original", "Sequential", "Sequential+MC", "Permuted", "Permuted+MC")
+
+def plot_comparison_axes(axs, panels, titles=comparison_titles, fontsize=35):
+    # Draws the original image and its transforms on the given axes
+    
+    for ax, panel, title in zip(axs, panels, titles):
+        ax.imshow(panel)
+        ax.set_title(title, fontsize=fontsize)
+        ax.axis("off")
+
+def save_comparison(panels, filename, titles=comparison_titles, figsize=(20, 10), fontsize=35):
+    # Headless version of the display_all figure. The figure is drawn
+    # with the Agg canvas and written to the file without pyplot,
+    # so it also works in worker processes without a display.
+    
+    fig = new_figure(headless=True, figsize=figsize)
+    axs = fig.subplots(1, len(panels))
+    
+    plot_comparison_axes(axs, panels, titles=titles, fontsize=fontsize)
+    
+    fig.tight_layout()
+    fig.savefig(filename)
+
+#----------------TRANSFORM CACHE----------------#
+
+# The transforms of display_all are stored in the cache directory
+# as one .npy file with the five panels, so that the comparison
+# can be drawn again with other titles, sizes or fonts without
+# running the scarce transforms and the Monte Carlo again.
+# Only seeded results are cached, since the others are random.
+
+transform_cache_dir = "transforms_cache"
+
+# Part of the key, bumped when the transforms change so that
+# the results cached by older versions are not used
+transform_cache_version = 2
+
+def transform_cache_key(image_original, scarce_palette, imagesize=(40, 30), m=1,
+                        scarcity_weight=0.9, adjust=False, nsteps=100000, seed=None):
+    # Key of the transforms from the contents of the image and the
+    # palette and all the parameters of compute_transforms
+    
+    image_original = np.ascontiguousarray(image_original)
+    image_key = hashlib.sha1(image_original.tobytes())
+    image_key.update(repr(image_original.shape).encode())
+    
+    params = (tuple(imagesize), m, float(scarcity_weight), bool(adjust), nsteps, seed,
+              transform_cache_version)
+    key = hashlib.sha1(image_key.digest())
+    key.update(palette_hash(scarce_palette[0], scarce_palette[1]).encode())
+    key.update(repr(params).encode())
+    
+    return key.hexdigest()[:16]
+
+def compute_transforms(image_original, scarce_palette, imagesize=(40, 30), m=1,
+                       scarcity_weight=0.9, adjust=False, nsteps=100000, seed=None):
+    # Computes the five panels of display_all: the resized image, the
+    # sequential and permuted transforms and their MC refinements.
+    # The seed fixes the permutation and the Monte Carlo steps.
     
     # Resizes the image to wanted size
     image = cv2.resize(image_original, imagesize)
     
     # Sequential algorithm
-    scrc = multiply_palette(scarce_palette, m=m)
+    scrc_m = multiply_palette(scarce_palette, m=m)
+    scrc = scrc_m.copy()
     image_scarce = transform_image_scarce(image, scrc, adjust=adjust, scarcity_weight=scarcity_weight)
     image_scarce_cp = np.copy(image_scarce)
     
     # Permuted algorithm
-    scrc = multiply_palette(scarce_palette, m=m)
-    image_scarce_permute = transform_image_scarce_permute(image, scrc, adjust=adjust, scarcity_weight=scarcity_weight)
+    scrc = scrc_m.copy()
+    image_scarce_permute = transform_image_scarce_permute(image, scrc, adjust=adjust,
+                                                          scarcity_weight=scarcity_weight, seed=seed)
     image_scarce_permute_cp = np.copy(image_scarce_permute)
     
     # Monte Carlo refinement for both alhorithms
+    if seed is not None:
+        np.random.seed(seed)
     image_scarce_permute_mc = transform_mc(image_scarce_permute_cp, image, adjust=adjust, steps=nsteps)
     image_scarce_mc = transform_mc(image_scarce_cp, image, adjust=adjust, steps=nsteps)
+    
+    return [image, image_scarce, image_scarce_mc, image_scarce_permute, image_scarce_permute_mc]
 
+def load_transforms(image_original, scarce_palette, imagesize=(40, 30), m=1, scarcity_weight=0.9,
+                    adjust=False, nsteps=100000, seed=None, cache_dir=transform_cache_dir):
+    # Returns the five panels of display_all from the cache directory,
+    # or computes them and stores them if they are not cached yet
+    
+    params = dict(imagesize=imagesize, m=m, scarcity_weight=scarcity_weight,
+                  adjust=adjust, nsteps=nsteps, seed=seed)
+    
+    if seed is None or cache_dir is None:
+        return compute_transforms(image_original, scarce_palette, **params)
+    
+    name = "transforms_"+transform_cache_key(image_original, scarce_palette, **params)+".npy"
+    cache_path = path.join(cache_dir, name)
+    
+    if path.exists(cache_path):
+        return list(np.load(cache_path))
+    
+    panels = compute_transforms(image_original, scarce_palette, **params)
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path+f".{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as handle:
+        np.save(handle, np.stack(panels))
+    os.replace(tmp_path, cache_path)
+    
+    return panels
 
-    fig, axs = plt.subplots(1, 5, figsize=(20, 10))
-
-    axs[0].imshow(image)
-    axs[0].set_title("Original", fontsize=35)
-    axs[0].axis("off")
+def render_all(image_original, scarce_palette, filename, imagesize=(40, 30), m=1,
+               scarcity_weight=0.9, adjust=False, nsteps=100000, seed=None,
+               cache_dir=transform_cache_dir, titles=comparison_titles, figsize=(20, 10), fontsize=35):
+    # Headless display_all: writes the comparison figure to the file,
+    # using the cached transforms when they are available
+    
+    panels = load_transforms(image_original, scarce_palette, imagesize=imagesize, m=m,
+                             scarcity_weight=scarcity_weight, adjust=adjust, nsteps=nsteps,
+                             seed=seed, cache_dir=cache_dir)
+    save_comparison(panels, filename, titles=titles, figsize=figsize, fontsize=fontsize)
+    
+    return panels
 
-    axs[1].imshow(image_scarce)
-    axs[1].set_title("Sequential", fontsize=35)
-    axs[1].axis("off")
-    
-    axs[2].imshow(image_scarce_mc)
-    axs[2].set_title("Sequential+MC", fontsize=35)
-    axs[2].axis("off")
+def display_all(image_original, scarce_palette, imagesize=(40, 30), m=1,
+                scarcity_weight=0.9, adjust=False, nsteps=100000, save=False, name="test",
+                seed=None, cache_dir=transform_cache_dir):
+    # Takes the original image and scarce palette
+    # and displays the original image along the 
+    # transforms and Monte Carlo refinements.
+    # Seeded transforms are cached in cache_dir.
     
-    axs[3].imshow(image_scarce_permute)
-    axs[3].set_title("Permuted", fontsize=35)
-    axs[3].axis("off")
+    panels = load_transforms(image_original, scarce_palette, imagesize=imagesize, m=m,
+                             scarcity_weight=scarcity_weight, adjust=adjust, nsteps=nsteps,
+                             seed=seed, cache_dir=cache_dir)
 
-    axs[4].imshow(image_scarce_permute_mc)
-    axs[4].set_title("Permuted+MC", fontsize=35)
-    axs[4].axis("off")
+    fig, axs = plt.subplots(1, 5, figsize=(20, 10))
+    
+    plot_comparison_axes(axs, panels)
 
     plt.tight_layout()
 
@@ -415,4 +1357,4 @@ def display_all(image_original, scarce_palette, imagesize=(40, 30), m=1,
     if save==True:
         plt.savefig("images/transforms/"+name+".jpg")
         
-    plt.show()
\ No newline at end of file
+    plt.show()
@@ -0,0 +1,748 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import cv2
+import cube_image_transform as cit
+
+# Numba is optional. Without it the "auto" backend
+# falls back to the batched NumPy sweeps.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Vectorized Monte Carlo engine for the cube refinement.
+# The MC swaps only permute the cubes, so the set of colors in
+# the image never changes. The image is stored as an array of
+# color labels together with the matrix of distances between
+# every original pixel and every available color. A proposal
+# then costs a few array lookups instead of four rgb_distance calls.
+
+###########################################
+############# MC STATE METHODS ############
+###########################################
+
+class MCState:
+
+    def __init__(self, image, image_original, adjust=False, chunk_size=65536, metric=None):
+        # Splits the image into labels of its distinct colors
+        # and precomputes the per-pixel cost caches
+
+        self.shape = image.shape
+        self.dtype = image.dtype
+
+        xdim, ydim, zdim = image.shape
+        colors, labels = np.unique(image.reshape(xdim*ydim, zdim), axis=0, return_inverse=True)
+
+        self.colors = colors
+        self.labels = labels.ravel().astype(np.intp)
+        self.dist = color_cost_matrix(image_original, colors, adjust=adjust, chunk_size=chunk_size,
+                                      metric=metric)
+        self.cost = self.dist[np.arange(len(self.labels)), self.labels]
+
+        # Built on demand by the class proposals
+        self.index = None
+
+    @classmethod
+    def from_labels(cls, labels, dist, colors=None, shape=None, dtype=None):
+        # Builds the state from labels and a precomputed distance matrix,
+        # so several chains can share the same colors and distances
+
+        state = cls.__new__(cls)
+        state.shape = shape
+        state.dtype = dtype
+        state.colors = colors
+        state.labels = np.array(labels, dtype=np.intp)
+        state.dist = dist
+        state.cost = dist[np.arange(len(state.labels)), state.labels]
+        state.index = None
+
+        return state
+
+    @property
+    def size(self):
+        return len(self.labels)
+
+    def total_cost(self):
+        return float(np.sum(self.cost))
+
+    def image(self):
+        # Rebuilds the image from the color labels
+
+        return self.colors[self.labels].astype(self.dtype).reshape(self.shape)
+
+def color_cost_matrix(image_original, colors, adjust=False, chunk_size=65536, metric=None):
+    # Distances between every original pixel and every color,
+    # computed in chunks with the shape (pixels, colors).
+    # With a metric from cit.distance_metrics, the colors are
+    # converted to its color space in bulk.
+
+    zdim = image_original.shape[-1]
+    pixels = image_original.reshape(-1, zdim)
+    dist = np.empty((len(pixels), len(colors)))
+
+    for start in range(0, len(pixels), chunk_size):
+        chunk = pixels[start:start+chunk_size]
+        dist[start:start+chunk_size] = cit.palette_distance_matrix(chunk, colors, adjust=adjust,
+                                                                   metric=metric)
+
+    return dist
+
+###########################################
+############# PROPOSAL METHODS ############
+###########################################
+
+# The proposal schedulers:
+#   "uniform" - source and target are uniform over the image, as in cit.swap_mc
+#   "class"   - the source is uniform, and the target is the best of a few
+#               pixels that hold a color which would lower the cost of the
+#               source. The pixels are indexed by their current color.
+#   "window"  - the target is drawn from a square window around the source
+# The class proposals are not symmetric, so at positive temperatures
+# they do not sample the Boltzmann distribution exactly. They are meant
+# for the greedy descent and the cold end of an annealing run.
+
+mc_proposals = ("uniform", "class", "window")
+
+class LabelIndex:
+    # Pixels grouped by their current color label. The swaps never
+    # change the number of cubes of a color, so every color keeps a
+    # fixed slice of the order array and a swap only exchanges two slots.
+
+    def __init__(self, labels, ncolors):
+
+        self.order = np.argsort(labels, kind="stable")
+        self.counts = np.bincount(labels, minlength=ncolors)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+        self.pos = np.empty_like(self.order)
+        self.pos[self.order] = np.arange(len(self.order))
+
+    def sample(self, rng, labels):
+        # One uniform pixel currently holding each of the given labels
+
+        slots = (rng.random(len(labels))*self.counts[labels]).astype(np.intp)
+
+        return self.order[self.offsets[labels]+slots]
+
+    def swap(self, src, tgt):
+        # Updates the index after swapping the disjoint src and tgt pixels
+
+        pos_src = self.pos[src]
+        pos_tgt = self.pos[tgt]
+        self.order[pos_src] = tgt
+        self.order[pos_tgt] = src
+        self.pos[src] = pos_tgt
+        self.pos[tgt] = pos_src
+
+def disjoint_pairs(pairs):
+    # Keeps only the (source, target) pairs whose pixels do not appear
+    # anywhere earlier in the batch. The kept swaps touch disjoint
+    # pixels, so applying them at once is the same as one by one.
+
+    npairs = len(pairs)
+
+    _, first = np.unique(pairs.ravel(), return_index=True)
+    is_first = np.zeros(2*npairs, dtype=bool)
+    is_first[first] = True
+
+    keep = is_first.reshape(npairs, 2).all(axis=1)
+
+    return pairs[keep, 0], pairs[keep, 1]
+
+def draw_disjoint_pairs(rng, size, batch_size):
+    # Draws a batch of uniform pairs without overlapping pixels
+
+    return disjoint_pairs(rng.integers(0, size, (batch_size, 2)))
+
+def draw_class_pairs(state, rng, batch_size, tries=4):
+    # Draws a batch of pairs in which the target holds a color that
+    # would lower the cost of the source. The color is picked at random
+    # among such colors, and the target is the one of tries holders of
+    # the color that loses the least by taking the color of the source.
+
+    if state.index is None:
+        state.index = LabelIndex(state.labels, state.dist.shape[1])
+
+    src = rng.integers(0, state.size, batch_size)
+
+    # Sources that already have their closest color are dropped
+    better = state.dist[src] < state.cost[src, None]
+    has_better = better.any(axis=1)
+    src = src[has_better]
+    better = better[has_better]
+
+    wanted = np.argmax(rng.random(better.shape)*better, axis=1)
+
+    candidates = np.stack([state.index.sample(rng, wanted) for i in range(tries)], axis=1)
+    loss = state.dist[candidates, state.labels[src, None]]-state.cost[candidates]
+    tgt = candidates[np.arange(len(src)), np.argmin(loss, axis=1)]
+
+    return disjoint_pairs(np.stack((src, tgt), axis=1))
+
+def draw_window_pairs(state, rng, batch_size, window=2):
+    # Draws a batch of pairs with the target at most window
+    # pixels away from the source in both directions
+
+    xdim, ydim = state.shape[:2]
+
+    src = rng.integers(0, state.size, batch_size)
+    x_src, y_src = np.divmod(src, ydim)
+
+    x_tgt = np.clip(x_src+rng.integers(-window, window+1, batch_size), 0, xdim-1)
+    y_tgt = np.clip(y_src+rng.integers(-window, window+1, batch_size), 0, ydim-1)
+    tgt = x_tgt*ydim+y_tgt
+
+    return disjoint_pairs(np.stack((src, tgt), axis=1))
+
+def swap_delta(state, src, tgt):
+    # Cost change of swapping the cubes at src and tgt
+
+    lab_src = state.labels[src]
+    lab_tgt = state.labels[tgt]
+
+    delta = (state.dist[src, lab_tgt]-state.cost[src])+(state.dist[tgt, lab_src]-state.cost[tgt])
+
+    return delta
+
+def apply_swaps(state, src, tgt):
+    # Swaps the cubes at disjoint src and tgt pixels
+    # and updates only the touched cache entries
+
+    lab_src = state.labels[src]
+    state.labels[src] = state.labels[tgt]
+    state.labels[tgt] = lab_src
+
+    state.cost[src] = state.dist[src, state.labels[src]]
+    state.cost[tgt] = state.dist[tgt, state.labels[tgt]]
+
+    if state.index is not None:
+        state.index.swap(src, tgt)
+
+def default_batch_size(size):
+    # Batches much smaller than the image keep the fraction of
+    # proposals dropped due to overlapping pixels low
+
+    return int(np.clip(size//16, 1, 8192))
+
+def accept_swaps(rng, delta, temperature=0.0):
+    # Metropolis acceptance of the proposed swaps. At zero
+    # temperature only the swaps that do not increase the
+    # cost are accepted, as in cit.swap_mc.
+
+    acc = delta <= 0
+
+    if temperature > 0:
+        uphill = ~acc
+        acc[uphill] = rng.random(np.count_nonzero(uphill)) < np.exp(-delta[uphill]/temperature)
+
+    return acc
+
+def mc_sweep_kernel(labels, cost, dist, nproposals, temperature, seed):
+    # Sequential swap proposals, one at a time as in cit.swap_mc.
+    # Compiled with numba when it is available.
+
+    np.random.seed(seed)
+    size = labels.shape[0]
+    accepted = 0
+
+    for step in range(nproposals):
+        src = np.random.randint(0, size)
+        tgt = np.random.randint(0, size)
+
+        lab_src = labels[src]
+        lab_tgt = labels[tgt]
+        delta = (dist[src, lab_tgt]-cost[src])+(dist[tgt, lab_src]-cost[tgt])
+
+        if delta <= 0 or (temperature > 0 and np.random.random() < np.exp(-delta/temperature)):
+            labels[src] = lab_tgt
+            labels[tgt] = lab_src
+            cost[src] = dist[src, lab_tgt]
+            cost[tgt] = dist[tgt, lab_src]
+            accepted += 1
+
+    return accepted
+
+if numba is not None:
+    mc_sweep_kernel = numba.njit(cache=True)(mc_sweep_kernel)
+
+mc_backends = ("auto", "numpy", "numba")
+
+def resolve_backend(backend):
+    # "auto" picks the compiled kernel when numba is installed
+
+    if backend not in mc_backends:
+        raise ValueError(f"Unknown MC backend: {backend}")
+
+    if backend == "auto":
+        return "numpy" if numba is None else "numba"
+
+    if backend == "numba" and numba is None:
+        raise ImportError("The numba MC backend needs numba to be installed")
+
+    return backend
+
+def mc_sweep(state, rng, nproposals, batch_size=None, temperature=0.0, backend="numpy",
+             proposals="uniform", window=2, stats=None):
+    # Performs nproposals swap proposals on the state in batches
+    # of disjoint swaps, or one by one in the compiled kernel
+    # with the numba backend. Returns the number of accepted swaps.
+    # With a stats dictionary, the numbers of proposed, accepted and
+    # effective swaps (those that exchange two different colors)
+    # are added to it.
+
+    if proposals not in mc_proposals:
+        raise ValueError(f"Unknown MC proposals: {proposals}")
+
+    # The compiled kernel only does the uniform proposals
+    if backend == "auto" and proposals != "uniform":
+        backend = "numpy"
+
+    if resolve_backend(backend) == "numba":
+        if proposals != "uniform":
+            raise ValueError("The numba MC backend only supports uniform proposals")
+
+        # The kernel moves the cubes behind the back of the index
+        state.index = None
+
+        seed = int(rng.integers(2**63))
+        accepted = int(mc_sweep_kernel(state.labels, state.cost, state.dist, int(nproposals),
+                                       float(temperature), seed))
+        if stats is not None:
+            stats["proposed"] = stats.get("proposed", 0)+int(nproposals)
+            stats["accepted"] = stats.get("accepted", 0)+accepted
+        return accepted
+
+    if batch_size is None:
+        batch_size = default_batch_size(state.size)
+
+    drawn = 0
+    proposed = 0
+    accepted = 0
+
+    if state.size < 2:
+        return accepted
+
+    effective = 0
+
+    # The sweep ends after nproposals drawn sources. The pairs that
+    # are dropped still count here, otherwise a converged image with
+    # no improvable source would never finish a class sweep.
+    while drawn < nproposals:
+        nbatch = min(batch_size, nproposals-drawn)
+        drawn += nbatch
+        if proposals == "class":
+            src, tgt = draw_class_pairs(state, rng, nbatch)
+        elif proposals == "window":
+            src, tgt = draw_window_pairs(state, rng, nbatch, window=window)
+        else:
+            src, tgt = draw_disjoint_pairs(rng, state.size, nbatch)
+
+        # Pairs dropped for overlapping (including self-swaps,
+        # which never change the image) are not counted, and neither
+        # are the class proposals of pixels with their closest color
+        proposed += len(src)
+
+        delta = swap_delta(state, src, tgt)
+        acc = accept_swaps(rng, delta, temperature=temperature)
+        if stats is not None:
+            effective += int(np.count_nonzero(acc & (state.labels[src] != state.labels[tgt])))
+        apply_swaps(state, src[acc], tgt[acc])
+        accepted += int(np.count_nonzero(acc))
+
+    if stats is not None:
+        stats["proposed"] = stats.get("proposed", 0)+proposed
+        stats["accepted"] = stats.get("accepted", 0)+accepted
+        stats["effective"] = stats.get("effective", 0)+effective
+
+    return accepted
+
+#############################################
+############# TRANSFORM METHODS #############
+#############################################
+
+def transform_mc_batched(image, image_original, steps=10000, adjust=False, batch_size=None, seed=None,
+                         metric=None, backend="auto", proposals="uniform", window=2, stats=None):
+    # Batched version of cit.transform_mc. It performs the same
+    # greedy swaps, so the results are statistically equivalent,
+    # and the image is modified in place as in the original method.
+    # The backend is one of mc_backends and proposals one of mc_proposals.
+
+    rng = np.random.default_rng(seed)
+
+    state = MCState(image, image_original, adjust=adjust, metric=metric)
+    mc_sweep(state, rng, steps, batch_size=batch_size, backend=backend, proposals=proposals,
+             window=window, stats=stats)
+
+    image[...] = state.image()
+
+    return image
+
+def compare_proposals(image, image_original, steps=100000, adjust=False, seed=None, metric=None,
+                      schedulers=mc_proposals, window=2):
+    # Runs the greedy refinement from the same start with every
+    # proposal scheduler and reports the acceptance rate, the rate
+    # of effective swaps per second and the final cost for each
+
+    import time
+
+    report = {}
+    for proposals in schedulers:
+        stats = {}
+        start = time.perf_counter()
+        result = transform_mc_batched(np.copy(image), image_original, steps=steps, adjust=adjust,
+                                      seed=seed, metric=metric, backend="numpy",
+                                      proposals=proposals, window=window, stats=stats)
+        seconds = time.perf_counter()-start
+
+        report[proposals] = {"acceptance": stats["accepted"]/max(stats["proposed"], 1),
+                             "effective_rate": stats["effective"]/seconds,
+                             "proposals_per_second": stats["proposed"]/seconds,
+                             "cost": MCState(result, image_original, adjust=adjust, metric=metric).total_cost()}
+
+    return report
+
+#############################################
+############# ANNEALING METHODS #############
+#############################################
+
+# A temperature schedule is any function that takes the sweep
+# index and the total number of sweeps and returns the temperature.
+# The temperature is measured in the units of the color distance.
+
+def constant_schedule(temperature):
+
+    def schedule(sweep, nsweeps):
+        return temperature
+
+    return schedule
+
+def linear_schedule(t_start, t_end=0.0):
+
+    def schedule(sweep, nsweeps):
+        return t_start+(t_end-t_start)*sweep/max(nsweeps-1, 1)
+
+    return schedule
+
+def exponential_schedule(t_start, t_end=1e-4):
+    # Geometric cooling from t_start to t_end
+
+    def schedule(sweep, nsweeps):
+        return t_start*(t_end/t_start)**(sweep/max(nsweeps-1, 1))
+
+    return schedule
+
+def transform_mc_anneal(image, image_original, nsweeps=100, schedule=None, adjust=False,
+                        batch_size=None, patience=10, tol=1e-4, seed=None, metric=None, backend="auto",
+                        proposals="uniform", window=2):
+    # Simulated annealing refinement of the image. One sweep has as many
+    # proposals as there are pixels. The run stops early when the best
+    # cost has improved by less than a relative tol over the last
+    # patience sweeps and the cost has not moved by more than tol.
+    # The image is set in place to the best layout found and returned
+    # together with the per-sweep history. Swaps of two cubes of the
+    # same color are always accepted and count in the acceptance rate.
+
+    if schedule is None:
+        schedule = exponential_schedule(0.05)
+
+    rng = np.random.default_rng(seed)
+    state = MCState(image, image_original, adjust=adjust, metric=metric)
+
+    best_cost = state.total_cost()
+    best_labels = np.copy(state.labels)
+
+    history = {"temperature": [], "acceptance": [], "cost": [], "best_cost": []}
+
+    for sweep in range(nsweeps):
+        temperature = schedule(sweep, nsweeps)
+        accepted = mc_sweep(state, rng, state.size, batch_size=batch_size, temperature=temperature,
+                            backend=backend, proposals=proposals, window=window)
+
+        # The cost is summed again from the cache every sweep,
+        # so the rounding errors of the deltas do not accumulate
+        cost = state.total_cost()
+        if cost < best_cost:
+            best_cost = cost
+            best_labels[:] = state.labels
+
+        history["temperature"].append(temperature)
+        history["acceptance"].append(accepted/max(state.size, 1))
+        history["cost"].append(cost)
+        history["best_cost"].append(best_cost)
+
+        # The best cost stays flat in the hot phase as well,
+        # so the chain also has to be frozen over the window
+        if patience and sweep >= patience:
+            previous = history["best_cost"][-patience-1]
+            recent = history["cost"][-patience-1:]
+            plateau = previous-best_cost <= tol*abs(previous)
+            frozen = max(recent)-min(recent) <= tol*abs(best_cost)
+            if plateau and frozen:
+                break
+
+    state.labels = best_labels
+    image[...] = state.image()
+
+    return image, history
+
+##############################################
+############# PARALLEL TEMPERING #############
+##############################################
+
+# The distance matrix is sent to every worker process once
+# when the pool starts, instead of with every task
+worker_dist = None
+
+def init_tempering_worker(dist):
+    global worker_dist
+    worker_dist = dist
+
+def run_chain(labels, temperature, nsweeps, seed, batch_size=None, dist=None, backend="auto"):
+    # Runs one replica at a fixed temperature for nsweeps sweeps.
+    # Returns its final labels, the cost after every sweep, the number
+    # of accepted swaps and the best cost and labels it has visited.
+
+    if dist is None:
+        dist = worker_dist
+
+    rng = np.random.default_rng(seed)
+    state = MCState.from_labels(labels, dist)
+
+    best_cost = state.total_cost()
+    best_labels = np.copy(state.labels)
+    costs = []
+    accepted = 0
+
+    for sweep in range(nsweeps):
+        accepted += mc_sweep(state, rng, state.size, batch_size=batch_size, temperature=temperature,
+                             backend=backend)
+
+        cost = state.total_cost()
+        costs.append(cost)
+        if cost < best_cost:
+            best_cost = cost
+            best_labels[:] = state.labels
+
+    return state.labels, costs, accepted, best_cost, best_labels
+
+def tempering_starts(image, scarce_palette, nrandom=2, m=1, scarcity_weight=0.9, adjust=False, seed=None,
+                     metric=None):
+    # Starting layouts for the replicas: the sequential and permuted
+    # scarce transforms and random permutations of the sequential one
+
+    rng = np.random.default_rng(seed)
+
+    image_scarce = cit.transform_image_scarce(image, cit.multiply_palette(scarce_palette, m=m),
+                                              scarcity_weight=scarcity_weight, adjust=adjust, metric=metric)
+    image_permute = cit.transform_image_scarce_permute(image, cit.multiply_palette(scarce_palette, m=m),
+                                                       scarcity_weight=scarcity_weight, adjust=adjust,
+                                                       seed=rng.integers(2**32), metric=metric)
+
+    xdim, ydim, zdim = image.shape
+    starts = [image_scarce, image_permute]
+    for i in range(nrandom):
+        pixels = rng.permutation(image_scarce.reshape(xdim*ydim, zdim))
+        starts.append(pixels.reshape(xdim, ydim, zdim))
+
+    return starts
+
+def transform_mc_tempering(starts, image_original, temperatures, nsweeps=100, exchange_every=5,
+                           adjust=False, batch_size=None, workers=None, seed=None, metric=None,
+                           backend="auto"):
+    # Parallel tempering refinement. Every start image is a replica that
+    # runs at one of the temperatures, and the replicas run concurrently
+    # in a process pool (serially with workers=0). After every
+    # exchange_every sweeps the neighbouring temperatures try to swap
+    # their replicas with the usual replica exchange probability.
+    # Returns the best layout found by any replica and the history with
+    # the per-chain cost and temperature traces.
+
+    if len(starts) != len(temperatures):
+        raise ValueError("Every start needs its own temperature")
+    if min(temperatures) <= 0:
+        raise ValueError("The temperatures have to be positive")
+
+    shape = starts[0].shape
+    dtype = starts[0].dtype
+    zdim = shape[-1]
+
+    # All replicas are labelled with the same colors so that
+    # they can share one distance matrix
+    pixels = np.concatenate([start.reshape(-1, zdim) for start in starts])
+    colors, labels = np.unique(pixels, axis=0, return_inverse=True)
+    labels = labels.reshape(len(starts), -1)
+    dist = color_cost_matrix(image_original, colors, adjust=adjust, metric=metric)
+
+    nchains = len(starts)
+    # The slots are the sorted temperatures, and every chain
+    # starts in the slot of the temperature given with it
+    temperatures = np.asarray(temperatures, dtype=float)
+    slot_chain = np.argsort(temperatures, kind="stable")
+    temperatures = temperatures[slot_chain]
+    chains = [labels[i] for i in range(nchains)]
+
+    seq = np.random.SeedSequence(seed)
+    rng = np.random.default_rng(seq.spawn(1)[0])
+
+    history = {"cost": [[] for i in range(nchains)], "temperature": [[] for i in range(nchains)],
+               "accepted": np.zeros(nchains, dtype=np.int64), "exchanges": 0, "exchange_attempts": 0}
+
+    best_cost = np.inf
+    best_labels = None
+
+    pool = None
+    if workers != 0:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_tempering_worker, initargs=(dist,))
+
+    try:
+        done = 0
+        rnd = 0
+        while done < nsweeps:
+            nround = min(exchange_every, nsweeps-done)
+            seeds = [child.generate_state(1)[0] for child in seq.spawn(nchains)]
+            chain_temps = np.empty(nchains)
+            chain_temps[slot_chain] = temperatures
+
+            if pool is None:
+                results = [run_chain(chains[c], chain_temps[c], nround, seeds[c], batch_size, dist, backend)
+                           for c in range(nchains)]
+            else:
+                results = list(pool.map(run_chain, chains, chain_temps, [nround]*nchains, seeds,
+                                        [batch_size]*nchains, [None]*nchains, [backend]*nchains))
+
+            for c, (chain_labels, costs, accepted, chain_best, chain_best_labels) in enumerate(results):
+                chains[c] = chain_labels
+                history["cost"][c].extend(costs)
+                history["temperature"][c].extend([chain_temps[c]]*nround)
+                history["accepted"][c] += accepted
+                if chain_best < best_cost:
+                    best_cost = chain_best
+                    best_labels = chain_best_labels
+
+            # Even and odd neighbour pairs take turns in the exchanges
+            energies = np.array([history["cost"][c][-1] for c in range(nchains)])
+            for k in range(rnd % 2, nchains-1, 2):
+                c1, c2 = slot_chain[k], slot_chain[k+1]
+                x = (1/temperatures[k]-1/temperatures[k+1])*(energies[c1]-energies[c2])
+                history["exchange_attempts"] += 1
+                if x >= 0 or rng.random() < np.exp(x):
+                    slot_chain[k], slot_chain[k+1] = c2, c1
+                    history["exchanges"] += 1
+
+            done += nround
+            rnd += 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    history["cost"] = np.array(history["cost"])
+    history["temperature"] = np.array(history["temperature"])
+
+    best_state = MCState.from_labels(best_labels, dist, colors=colors, shape=shape, dtype=dtype)
+
+    return best_state.image(), history
+
+#############################################
+############# PYRAMID METHODS ###############
+#############################################
+
+# Coarse-to-fine refinement. The scarce transform and the greedy MC
+# run on a small grid first, the layout is upsampled to the next grid
+# as a warm start and only refined locally with the window proposals.
+# The same chain of warm starts serves a sweep over candidate sizes.
+
+def pyramid_sizes(imagesize, levels=3, factor=2):
+    # Grid sizes (width, height) from the coarsest to imagesize
+
+    width, height = imagesize
+    sizes = []
+    for level in range(levels-1, -1, -1):
+        size = (max(width//factor**level, 1), max(height//factor**level, 1))
+        if not sizes or size != sizes[-1]:
+            sizes.append(size)
+
+    return sizes
+
+def level_palette(scarce_palette, npixels, nfinal):
+    # Palette for a coarser grid with the counts scaled down by
+    # the ratio of the grid sizes, so that the colors are as scarce
+    # as on the final grid
+
+    palette = cit.ScarcePalette.from_palette(scarce_palette)
+    counts = np.ceil(palette.counts*npixels/nfinal).astype(np.int64)
+
+    return cit.ScarcePalette(palette.rgb, counts, names=palette.names)
+
+def upsample_layout(image_layout, image, scarce_palette, scarcity_weight=0.9, adjust=False, metric=None):
+    # Warm start for the finer grid: every pixel takes the color of
+    # the nearest coarse pixel. Colors used more often than the palette
+    # allows are taken from the pixels they fit worst, and those pixels
+    # get the remaining colors with the sequential scarce choice.
+
+    xdim, ydim, zdim = image.shape
+    xc, yc = image_layout.shape[:2]
+    rows = np.arange(xdim)*xc//xdim
+    cols = np.arange(ydim)*yc//ydim
+    layout = image_layout[rows[:, None], cols[None, :]].reshape(xdim*ydim, zdim)
+
+    palette = cit.ScarcePalette.from_palette(scarce_palette)
+    pixels = image.reshape(xdim*ydim, zdim)
+    labels = cit.quantize_indices(layout, palette.rgb)
+    dist = cit.palette_distance_matrix(pixels, palette.rgb, adjust=adjust, metric=metric)
+    cost = dist[np.arange(len(labels)), labels]
+
+    free = []
+    for i in range(len(palette.rgb)):
+        holders = np.flatnonzero(labels == i)
+        excess = len(holders)-palette.counts[i]
+        if excess > 0:
+            free.append(holders[np.argsort(cost[holders], kind="stable")[len(holders)-excess:]])
+            palette.counts[i] = 0
+        else:
+            palette.counts[i] -= len(holders)
+    free = np.sort(np.concatenate(free)) if free else np.empty(0, dtype=np.intp)
+    palette.total[0] = palette.counts.sum()
+
+    if palette.total[0] < len(free):
+        raise Exception("There is not enough colors to recreate the image")
+
+    labels[free] = cit.choose_colors_scarce(pixels[free], palette, scarcity_weight=scarcity_weight,
+                                            metric=metric)
+
+    return palette.rgb[labels].reshape(xdim, ydim, zdim)
+
+def transform_mc_pyramid(image_original, scarce_palette, sizes, m=1, scarcity_weight=0.9, adjust=False,
+                         nsteps=100000, refine_sweeps=4, window=2, seed=None, metric=None, backend="auto"):
+    # Solves the coarsest of the sizes with the scarce transform and
+    # nsteps greedy MC steps, then refines every finer size for
+    # refine_sweeps sweeps of window proposals from the upsampled
+    # layout of the previous size. The sizes are (width, height) as
+    # in display_all, e.g. from pyramid_sizes. Returns a dictionary
+    # {size: (image, image_mc)} with the resized image of every size.
+
+    sizes = sorted(set(tuple(size) for size in sizes), key=lambda size: size[0]*size[1])
+    scarce_palette = cit.multiply_palette(scarce_palette, m=m)
+    nfinal = sizes[-1][0]*sizes[-1][1]
+    seeds = np.random.SeedSequence(seed).generate_state(len(sizes))
+
+    results = {}
+    image_mc = None
+    for size, level_seed in zip(sizes, seeds):
+        image = cv2.resize(image_original, size)
+        palette = level_palette(scarce_palette, size[0]*size[1], nfinal)
+
+        if image_mc is None:
+            start = cit.transform_image_scarce(image, palette, adjust=adjust, scarcity_weight=scarcity_weight,
+                                               metric=metric)
+            image_mc = transform_mc_batched(start, image, steps=nsteps, adjust=adjust, seed=level_seed,
+                                            metric=metric, backend=backend)
+        else:
+            start = upsample_layout(image_mc, image, palette, scarcity_weight=scarcity_weight,
+                                    adjust=adjust, metric=metric)
+            image_mc = transform_mc_batched(start, image, steps=refine_sweeps*size[0]*size[1],
+                                            adjust=adjust, seed=level_seed, metric=metric,
+                                            proposals="window", window=window)
+
+        results[size] = (image, image_mc)
+
+    return results
@@ -1,14 +1,16 @@
 import tkinter as tk
 from tkinter import ttk
 
-# The numpy random generator is preferrable,
-# although I don't want to import the rest
-# of numpy functionality. This can also be
-# removed later not to introduce unnecesary
-# dependencies.
+# The spins and the physics live in the headless
+# lattice engine, the app only draws the lattice
+# and passes the temperature to it.
 
-from numpy import random as rnd
-from math import exp
+import sys
+import time
+import numpy as np
+from ising_engine import IsingLattice
+from ising_worker import SimulationWorker
+from ising_observables import Observables
 
 # Plotting libraries and settings
 from matplotlib.backends.backend_tkagg import (
@@ -25,7 +27,7 @@ style.use("seaborn")
 
 class Ising:
     
-    def __init__(self, root, N):
+    def __init__(self, root, N, background=True):
         
         self.size = N
         self.paused = False	
@@ -34,20 +36,34 @@ class Ising:
 	# and it should exist independent of
 	# which simulation is used
         root.temperature = tk.DoubleVar()
-        root.magnetization = 0.0
 
-	# I should implement at least few system sizes
-	# but I need to figure out how to keep buttons
-	# as squares and not rectangles
+        # The lattice engine holds the spins, the energy and
+        # the magnetization, the view only observes it
+        self.lattice = IsingLattice(N, temperature=root.temperature.get())
+
+        # Running statistics of the samples shown in the plot,
+        # restarted whenever the temperature changes
+        self.observables = Observables()
+
+        # In the background mode the simulation runs in a worker
+        # process and the lattice above is only a copy of its latest
+        # snapshot, polled poll_interval milliseconds apart
+        self.worker = None
+        self.poll_interval = 16
+        self.last_sequence = -1
+        if background:
+            self.worker = SimulationWorker(N, temperature=root.temperature.get(),
+                                           algorithm=root.algorithm.get())
+        root.algorithm.trace_add("write", self.set_algorithm)
+
         mainframe = ttk.Frame(root, padding="5 5 5 5")
         mainframe.pack()
        
         simfrm = ttk.Frame(mainframe, padding="2 2 2 2")
         simfrm.grid(column=0, row=0)
       
-        # Build the simulation structure
-        self.buttons = [[Cell(simfrm, (i, j), N) for j in range(N)] for i in range(N)]
-        self.build_pointers()
+        # Draw the lattice as a single image
+        self.view = LatticeView(simfrm, self.lattice, click=self.flip)
 
         # The frame for the simulation control
         controlfrm = ttk.Frame(mainframe, padding="2 2 2 2")
@@ -77,34 +93,48 @@ class Ising:
         self.playbtn.grid(row=0, column=3, padx=10, pady=3)      
  
         # Initialize and draw the plot
-        self.plt = Plot(root, mainframe)
+        self.plt = Plot(root, mainframe, self.lattice, observables=self.observables)
 
         # Initialize the simulation
         self.simulate()
 
        
-    def build_pointers(self):
-        for button_row in self.buttons:
-            for button in button_row:
-                
-                btn_row, btn_col = button.position
-                
-                button.left = self.buttons[btn_row][(btn_col-1)%self.size]
-                button.right = self.buttons[btn_row][(btn_col+1)%self.size]
-                button.up = self.buttons[(btn_row-1)%self.size][btn_col]
-                button.down = self.buttons[(btn_row+1)%self.size][btn_col]
-
-         
     def simulate(self):
-        if not self.paused:
+        if self.worker is not None:
+            self.poll()
+            root.after(self.poll_interval, self.simulate)
+        elif not self.paused:
             self.step()
             root.after(3, self.simulate)
+
+    def poll(self):
+        # Copies the latest snapshot of the worker to the lattice
+        # which redraws the view, and adds a point to the plot
+        if self.worker.sequence == self.last_sequence:
+            return
+
+        # The sequence of the copied snapshot, a publish may have
+        # landed since the check above
+        spins, energy, magnetization, nupdates, sequence = self.worker.snapshot()
+        if sequence == self.last_sequence:
+            return
+        self.last_sequence = sequence
+
+        self.lattice.spins[...] = spins
+        self.lattice.energy = energy
+        self.lattice.magnetization = magnetization
+        self.lattice.notify(None)
+        self.observables.add(self.lattice)
+
+        self.plt.update(step=nupdates)
    
     def step(self):
-        # Perform one step of the simulation after which single spin
-        # is either flipped or stays the same
-        rx, ry = rnd.randint(0, self.size), rnd.randint(0, self.size)
-        self.buttons[rx][ry].change_color(root.temperature.get())
+        # Perform one step of the simulation with the chosen algorithm.
+        # A single spin is either flipped or stays the same, with the
+        # checkerboard sweeps every spin of the lattice gets one attempt
+        # and the cluster algorithms flip whole clusters of spins
+        self.lattice.update(root.algorithm.get(), root.temperature.get())
+        self.observables.add(self.lattice)
 
         # Update the plot
         next(self.plt.iterator)
@@ -112,6 +142,27 @@ class Ising:
 
     def set_temperature(self, event):
         self.temp_lbl.configure(text="T={:.2f}".format(root.temperature.get()))
+        self.lattice.temperature = root.temperature.get()
+        self.observables.reset()
+        if self.worker is not None:
+            self.worker.send("temperature", root.temperature.get())
+
+    def set_algorithm(self, *args):
+        if self.worker is not None:
+            self.worker.send("algorithm", root.algorithm.get())
+
+    def flip(self, i, j):
+        # Flips a spin clicked in the view
+        if self.worker is not None:
+            self.worker.send("flip", i, j)
+        else:
+            self.lattice.flip(i, j)
+
+    def close(self):
+        # Stops the worker process if there is one
+        if self.worker is not None:
+            self.worker.close()
+            self.worker = None
         
     def get_temperature(self):
         return root.temperature.get()
@@ -119,96 +170,101 @@ class Ising:
     def dump(self):
         # The function that dumps the contents of the grid
         # It should be tidied up at certain point
-        for button_row in self.buttons:
-            for button in button_row:
-                 
-                print("POSITION: ", button.position)               
-                print(" ", button.up.value ," ")
-                print(button.left.value, button.value, button.right.value)
-                print(" ", button.down.value, " ")
+        N = self.size
+        values = (self.lattice.spins+1)//2
+        for i in range(N):
+            for j in range(N):
+                
+                print("POSITION: ", (i, j))               
+                print(" ", values[(i-1)%N, j] ," ")
+                print(values[i, (j-1)%N], values[i, j], values[i, (j+1)%N])
+                print(" ", values[(i+1)%N, j], " ")
                 print("\n")         
     
     def pausesim(self):
         self.paused=True
+        if self.worker is not None:
+            self.worker.send("pause")
 
     def playsim(self):
         if self.paused:
             self.paused=False
-            self.simulate()
+            if self.worker is not None:
+                self.worker.send("play")
+            else:
+                self.simulate()
                 
-class Cell:
-            
-    def __init__(self, frame, position, N):
-        
-        self.position=position
-        self.value=rnd.randint(0, 2) # This is one way to initialize
-        self.spin=-1+2*self.value
-        self.text=f"{position}"
-        self.N = N
-
-        root.magnetization+=self.spin/N**2 # Append the spin value to calculate the initial
-                                           # magnetization
-
-        self.cell=ttk.Button(frame, width=0.5, style=root.style_names[self.value], command=self.change_color_click)
-        self.cell.grid(column=position[1],
-                        row=position[0],
-                        padx=0.05,
-                        pady=0.05,
-                        ipadx=7.5,
-                        ipady=1.0,
-                        sticky="nesw")
-            
-        self.left = None
-        self.right = None
-        self.up = None
-        self.down = None
-
+class LatticeView:
 
-    def change_color(self, temperature):
-	# Generate a random number, depending on the temperature and 
-        # and calculate the flip energy change and call bit_flip method 
-
-        r = rnd.random()
-        
-        deltaE = 4*self.spin*(self.neighbour_sum()-2)
-        gibbs=1.0
- 
-        if deltaE>=0:
-            try:
-                gibbs=exp(-deltaE/temperature)
-            except ZeroDivisionError:
-                gibbs=0.0
-            except OverflowError:
-                gibbs=0.0
-            except:
-                raise("Error: Not sure what happened!")        
-         
-        if r<gibbs:
-            self.value = self.bit_flip(self.value)
-            self.spin = -1+2*self.value
-            root.magnetization+=2*self.spin/self.N**2
-           
+    def __init__(self, frame, lattice, scale=None, fps=30, click=None):
+        # The lattice is drawn as one image on a canvas, every
+        # site as a square of scale x scale pixels. The rows that
+        # changed are redrawn in bulk at most fps times a second.
+        # A click calls click(i, j), by default flipping the spin.
         
-        self.cell.configure(style=root.style_names[self.value])
-
-    def change_color_click(self):
-
-        self.value = self.bit_flip(self.value)
-        self.spin = -1+2*self.value
-        root.magnetization+=2*self.spin/self.N**2
-        self.cell.configure(style=root.style_names[self.value])        
-
-    def bit_flip(self, x):        
-        if x!=0 and x!=1:
-            raise ValueError("Not a bit!")      
-        return (1+x)%2
-
-    
-    def neighbour_sum(self):
-        return self.left.value+self.right.value+self.up.value+self.down.value
-
-    def set_temperature(self, temperature):
-        return root.temperature.set(temperature)
+        self.lattice = lattice
+        self.on_click = click or lattice.flip
+        N = lattice.size
+        self.scale = scale or max(1, 600//N)
+        self.interval = max(1, int(1000/fps))
+
+        # Colors of the spin down and up sites
+        self.colors = np.array([[int(color[k:k+2], 16) for k in (1, 3, 5)]
+                                for color in root.cell_colors], dtype=np.uint8)
+
+        self.photo = tk.PhotoImage(width=N*self.scale, height=N*self.scale)
+        self.canvas = tk.Canvas(frame, width=N*self.scale, height=N*self.scale,
+                                highlightthickness=0)
+        self.canvas.create_image(0, 0, anchor="nw", image=self.photo)
+        self.canvas.grid(column=0, row=0)
+        self.canvas.bind("<Button-1>", self.click)
+
+        # Range of the rows to be redrawn
+        self.dirty = (0, N)
+        self.pending = False
+
+        lattice.add_observer(self.mark_dirty)
+        self.draw()
+
+    def mark_dirty(self, lattice, site):
+        # Observer of the lattice. Remembers the changed rows
+        # and schedules a redraw if none is pending
+        if site is None:
+            rows = (0, lattice.size)
+        else:
+            rows = (site[0], site[0]+1)
+
+        if self.dirty is None:
+            self.dirty = rows
+        else:
+            self.dirty = (min(self.dirty[0], rows[0]), max(self.dirty[1], rows[1]))
+
+        if not self.pending:
+            self.pending = True
+            root.after(self.interval, self.draw)
+
+    def draw(self):
+        # Redraws the changed rows with a single image update
+        self.pending = False
+        if self.dirty is None:
+            return
+
+        start, stop = self.dirty
+        self.dirty = None
+
+        values = (self.lattice.spins[start:stop]+1)//2
+        pixels = self.colors[values]
+        pixels = np.repeat(np.repeat(pixels, self.scale, axis=0), self.scale, axis=1)
+
+        height, width = pixels.shape[:2]
+        ppm = f"P6 {width} {height} 255 ".encode()+pixels.tobytes()
+        self.photo.put(ppm, to=(0, start*self.scale))
+
+    def click(self, event):
+        # Flips the spin of the clicked site
+        i, j = event.y//self.scale, event.x//self.scale
+        if 0 <= i < self.lattice.size and 0 <= j < self.lattice.size:
+            self.on_click(i, j)
 
 class Menu:
 
@@ -224,8 +280,17 @@ class Menu:
         menubar.add_cascade(menu=menu_sim, label="Simulation")
         menubar.add_cascade(menu=menu_help, label="Help")
 
+        # The update algorithm belongs to the whole app
+        # in the same way as the temperature
+        root.algorithm = tk.StringVar(value="single")
+
         menu_sim_list = tk.Menu(menu_sim)
         menu_sim.add_cascade(menu=menu_sim_list, label="Choose")
+        menu_sim_list.add_radiobutton(label="Single spin flips", variable=root.algorithm, value="single")
+        menu_sim_list.add_radiobutton(label="Checkerboard sweeps", variable=root.algorithm, value="sweep")
+        menu_sim_list.add_radiobutton(label="Wolff clusters", variable=root.algorithm, value="wolff")
+        menu_sim_list.add_radiobutton(label="Swendsen-Wang clusters", variable=root.algorithm,
+                                      value="swendsen-wang")
         menu_sim.add_command(command=self.exit_program, label="Exit Program")
 
     def exit_program(self):
@@ -264,10 +329,83 @@ class ExitWindow:
     def exit_no(self):
         self.win_exit.destroy()
 
+class Trace:
+
+    def __init__(self, capacity=2000, decimate=True):
+        # Fixed size storage of the (step, value) points of the plot.
+        # When it is full, either the history is decimated to half
+        # the points keeping the minimum and maximum of every group,
+        # or with decimate=False the oldest points are overwritten.
+
+        self.capacity = capacity - capacity % 4
+        self.decimate = decimate
+        self.x = np.zeros(self.capacity)
+        self.y = np.zeros(self.capacity)
+        self.n = 0
+        self.start = 0
+
+        # Samples per stored point and the bucket of samples
+        # that will be stored as its minimum and maximum
+        self.stride = 1
+        self.bucket = []
+
+    def append(self, x, y):
+        if self.stride == 1:
+            self.store(x, y)
+            return
+
+        self.bucket.append((x, y))
+        if len(self.bucket) == 2*self.stride:
+            points = sorted([min(self.bucket, key=lambda p: p[1]), max(self.bucket, key=lambda p: p[1])])
+            self.bucket = []
+            for point in points:
+                self.store(*point)
+
+    def store(self, x, y):
+        if self.n == self.capacity:
+            if self.decimate:
+                self.halve()
+            else:
+                # Ring buffer, overwrite the oldest point
+                self.x[self.start] = x
+                self.y[self.start] = y
+                self.start = (self.start+1) % self.capacity
+                return
+
+        self.x[self.n] = x
+        self.y[self.n] = y
+        self.n += 1
+
+    def halve(self):
+        # Every four points are replaced by the minimum and
+        # maximum among them, in the order of the steps
+
+        x = self.x.reshape(-1, 4)
+        y = self.y.reshape(-1, 4)
+        rows = np.arange(len(y))[:, None]
+        idcs = np.sort(np.stack([y.argmin(axis=1), y.argmax(axis=1)], axis=1), axis=1)
+
+        half = self.capacity//2
+        self.x[:half] = x[rows, idcs].ravel()
+        self.y[:half] = y[rows, idcs].ravel()
+        self.n = half
+        self.stride *= 2
+
+    def data(self):
+        # The stored points in the order of the steps
+
+        if self.start == 0:
+            return self.x[:self.n], self.y[:self.n]
+
+        return np.roll(self.x, -self.start), np.roll(self.y, -self.start)
+
 class Plot:
 
-    def __init__(self, root, mainframe):
+    def __init__(self, root, mainframe, lattice, capacity=2000, fps=20, observables=None):
         
+        self.lattice = lattice
+        self.observables = observables
+
         fig = Figure(figsize=(4, 3), dpi=100)
         self.ax = fig.add_subplot()
         fig.tight_layout()        
@@ -276,24 +414,30 @@ class Plot:
         self.pltfrm = ttk.Frame(mainframe, padding="50 20 10 20")
         self.pltfrm.grid(row=0, column=1, ipadx=80, ipady=45, sticky="n")
        
-        # Initialize the lists to be plotted
-        self.steps = []
-        self.magnetization_plot = []
+        # The plotted points are kept in a fixed size trace
+        # and the plot is redrawn at most fps times a second
+        self.trace = Trace(capacity)
+        self.interval = 1/fps
+        self.last_draw = 0.0
 
-        # The limit values of magnetization will be used to
+        # The limit values of magnetization are used to
         # draw the ylimits of the plot 
-        # TO BE IMPLEMENTED!!!
         self.max = 0.0
         self.min = 0.0
      
-        # Initialize the plot axis
-        self.line, = self.ax.plot(self.steps, self.magnetization_plot, linewidth=2)
+        # Initialize the plot axis. The line is animated, so that
+        # only the line is redrawn on top of the saved background
+        self.line, = self.ax.plot([], [], linewidth=2, animated=True)
         self.line.set_label("Magnetization")
         self.ax.tick_params(axis="both", which="major", labelsize=14)
         self.ax.legend(fontsize=14)
+        self.ax.set_xlim(0, 100)
+        self.ax.set_ylim(-0.1, 0.1)
 
         # Connect the figure to the tk interface
         self.canvas = FigureCanvasTkAgg(fig, master=self.pltfrm)
+        self.background = None
+        self.canvas.mpl_connect("draw_event", self.on_draw)
         self.canvas.draw()
         self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
         self.canvas.mpl_connect("key_press_event", key_press_handler)          
@@ -306,22 +450,57 @@ class Plot:
         #toolmgr.remove_tool("Zoom")
         self.toolbar.update()
         self.toolbar.pack(side=tk.BOTTOM, fill=tk.X)
+
+        # Mean magnetization with its error and autocorrelation time
+        self.stats_lbl = ttk.Label(self.pltfrm, text="")
+        self.stats_lbl.pack(side=tk.BOTTOM)
         
         # Build an iterator
         self.iterator = iter(self)
 
-    def update(self):
+    def on_draw(self, event):
+        # Saves the background after every full redraw,
+        # e.g. when the window is resized
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.line)
+
+    def update(self, step=None):
         # This function adds a point on the graph
-        # and redraws the plot
+        # and redraws the plot if it is time for it.
+        # The step can be given, e.g. by the worker.
          
-        self.steps.append(self.step)
-        self.magnetization_plot.append(root.magnetization)
-        # self.ax.set_xlim(-0.1, self.step)
-        self.ax.relim()
-        self.ax.autoscale_view()
-
-        self.line.set_data(self.steps, self.magnetization_plot)
-        self.canvas.draw()
+        if step is not None:
+            self.step = step
+        magnetization = self.lattice.magnetization_density
+        self.trace.append(self.step, magnetization)
+        self.max = max(self.max, magnetization)
+        self.min = min(self.min, magnetization)
+
+        now = time.perf_counter()
+        if now-self.last_draw < self.interval:
+            return
+        self.last_draw = now
+
+        if self.observables is not None and self.observables.n > 0:
+            abs_m = self.observables["abs_magnetization"]
+            self.stats_lbl.configure(text="<|m|>={:.4f} \u00b1 {:.4f}   \u03c4={:.1f}".format(
+                abs_m.mean, abs_m.error, abs_m.autocorrelation_time))
+
+        self.line.set_data(*self.trace.data())
+
+        # The axes are redrawn only when the limits change
+        xmin, xmax = self.ax.get_xlim()
+        ymin, ymax = self.ax.get_ylim()
+        margin = 0.05*max(self.max-self.min, 0.1)
+        ylim = (self.min-margin, self.max+margin)
+        if self.step > xmax or ylim[0] < ymin or ylim[1] > ymax or self.background is None:
+            self.ax.set_xlim(0, max(xmax, 2*self.step))
+            self.ax.set_ylim(min(ymin, ylim[0]), max(ymax, ylim[1]))
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.line)
+            self.canvas.blit(self.ax.bbox)
 
     # Building an iterator that adds steps to the simulation
     def __next__(self):
@@ -340,22 +519,10 @@ class AppStyle:
         root.style = ttk.Style()
         root.style.theme_use("alt")
 
-        root.style_names={0:"blue_cell.TButton", 1:"green_cell.TButton",
-                          2:"bluish.Horizontal.TScale", 3:"templbl.TLabel"}
-        
-        root.style.configure(root.style_names[0],
-                             font=("calibri", 8, "bold"),
-                             foreground="white",
-                                 #85151b 
-                             background="#365577",
-                             relief="sunken")
- 
-        root.style.configure(root.style_names[1],
-                             font=("calibri", 8, "bold"),
-                             foreground="white",
-                                  #211cb0
-                             background="#6d9a7d",
-                             relief="raised")
+        root.style_names={2:"bluish.Horizontal.TScale", 3:"templbl.TLabel"}
+
+        # Colors of the spin down and up sites of the lattice
+        root.cell_colors=("#365577", "#6d9a7d")
             
         root.style.configure(root.style_names[2],
                              relief="raised")
@@ -382,5 +549,9 @@ if __name__=="__main__":
     Menu(root)
     AppStyle(root)
     
-    ising_app = Ising(root, 30)
+    # The lattice size can be given on the command line
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+
+    ising_app = Ising(root, N)
     root.mainloop()
+    ising_app.close()
@@ -0,0 +1,399 @@
+import numpy as np
+from math import exp
+
+# Headless core of the Ising simulation. The spins live in a NumPy
+# int8 array with periodic boundaries, and the energy and the
+# magnetization are kept up to date on every flip, so the physics
+# runs without a display and on lattices of any size. The Tk app
+# only observes the lattice and redraws the sites that changed.
+#
+# Example:
+#     lattice = IsingLattice(512, temperature=2.0, seed=1)
+#     for i in range(1000):
+#         lattice.sweep()
+#     print(lattice.energy_density, lattice.magnetization_density)
+#
+# Near the critical temperature the cluster updates decorrelate
+# much faster than the single spin dynamics:
+#     lattice.update("wolff", temperature=2.27)
+#     print(compare_algorithms(64, 2.27))
+
+# Update algorithms of IsingLattice.update
+algorithms = ("single", "sweep", "wolff", "swendsen-wang")
+
+# Critical temperature of the square lattice
+critical_temperature = 2/np.log(1+np.sqrt(2))
+
+
+class IsingLattice:
+
+    def __init__(self, N, temperature=1.0, seed=None, spins=None):
+        # N x N lattice of spins +1/-1 with the coupling J=1 and no
+        # external field. Random initial spins unless given.
+
+        self.size = N
+        self.temperature = temperature
+        self.rng = np.random.default_rng(seed)
+
+        if spins is None:
+            spins = 2*self.rng.integers(0, 2, (N, N))-1
+        self.spins = np.array(spins, dtype=np.int8)
+
+        if self.spins.shape != (N, N):
+            raise ValueError(f"The spins should have the shape {(N, N)}")
+
+        # Running observables, updated by flip
+        self.energy = self.total_energy()
+        self.magnetization = int(self.spins.sum(dtype=np.int64))
+
+        # Number of single spin attempts made by step
+        # and of full lattice sweeps made by sweep
+        self.nsteps = 0
+        self.nsweeps = 0
+
+        # Acceptance probabilities of the five possible energy
+        # changes, cached for the last temperature used by sweep
+        self.table_temperature = None
+        self.table = None
+
+        # Sublattices of sites that are not neighbours of each other.
+        # For an even N these are the two colors of the checkerboard.
+        # An odd periodic row needs a third color at its seam, and the
+        # color (c(i)+c(j)) % 3 of the rows and columns then differs
+        # between all neighbours, which gives three sublattices.
+        if N % 2:
+            cycle = np.arange(N) % 2
+            cycle[-1] = 2
+            colors = np.add.outer(cycle, cycle) % 3
+            self.sublattices = tuple(colors == k for k in range(3))
+        else:
+            parity = np.add.outer(np.arange(N), np.arange(N)) % 2
+            self.sublattices = (parity == 0, parity == 1)
+
+        # Callbacks observer(lattice, site) called after the spins change,
+        # with site=(i, j) for a single flip and None for bulk updates
+        self.observers = []
+
+    def total_energy(self):
+        # Energy of the whole lattice, every bond counted once
+
+        spins = self.spins.astype(np.int64)
+        bonds = spins*np.roll(spins, 1, axis=0)+spins*np.roll(spins, 1, axis=1)
+
+        return -int(bonds.sum())
+
+    @property
+    def nspins(self):
+        return self.size*self.size
+
+    @property
+    def energy_density(self):
+        return self.energy/self.nspins
+
+    @property
+    def magnetization_density(self):
+        return self.magnetization/self.nspins
+
+    def neighbour_sum(self, i, j):
+        # Sum of the four neighbouring spins with periodic boundaries
+
+        N = self.size
+        spins = self.spins
+
+        return int(spins[(i-1)%N, j])+int(spins[(i+1)%N, j])+int(spins[i, (j-1)%N])+int(spins[i, (j+1)%N])
+
+    def delta_energy(self, i, j):
+        # Energy change if the spin at (i, j) was flipped
+
+        return 2*int(self.spins[i, j])*self.neighbour_sum(i, j)
+
+    def flip(self, i, j):
+        # Flips the spin at (i, j) and updates the observables
+
+        spin = int(self.spins[i, j])
+
+        self.energy += 2*spin*self.neighbour_sum(i, j)
+        self.magnetization -= 2*spin
+        self.spins[i, j] = -spin
+
+        self.notify((i, j))
+
+    def attempt(self, i, j, temperature=None):
+        # Metropolis attempt to flip the spin at (i, j).
+        # Returns True if the spin was flipped.
+
+        if temperature is None:
+            temperature = self.temperature
+
+        deltaE = self.delta_energy(i, j)
+
+        if deltaE > 0:
+            if temperature <= 0 or self.rng.random() >= exp(-deltaE/temperature):
+                return False
+
+        self.flip(i, j)
+
+        return True
+
+    def step(self, temperature=None):
+        # One step of the simulation after which a single random
+        # spin is either flipped or stays the same
+
+        i, j = self.rng.integers(0, self.size, 2)
+        self.nsteps += 1
+
+        return self.attempt(int(i), int(j), temperature=temperature)
+
+    def acceptance_table(self, temperature):
+        # Metropolis acceptance probabilities of the energy changes
+        # -8, -4, 0, 4 and 8, indexed by deltaE//4+2
+
+        if temperature != self.table_temperature:
+            deltaE = np.arange(-8, 9, 4)
+            if temperature > 0:
+                table = np.exp(-np.maximum(deltaE, 0)/temperature)
+            else:
+                table = (deltaE <= 0).astype(float)
+            self.table = table.astype(np.float32)
+            self.table_temperature = temperature
+
+        return self.table
+
+    def local_fields(self):
+        # Sum of the four neighbouring spins of every site
+
+        spins = self.spins
+
+        return (np.roll(spins, 1, axis=0)+np.roll(spins, -1, axis=0)
+                +np.roll(spins, 1, axis=1)+np.roll(spins, -1, axis=1))
+
+    def sweep(self, temperature=None):
+        # One Metropolis sweep over the whole lattice. The spins of one
+        # sublattice of the checkerboard are not neighbours of each other,
+        # so all of them are updated at once, first the even sites and
+        # then the odd ones (three sublattices for an odd size).
+        # Returns the number of flipped spins.
+
+        if temperature is None:
+            temperature = self.temperature
+        table = self.acceptance_table(temperature)
+
+        flipped = 0
+        for sublattice in self.sublattices:
+            deltaE = 2*self.spins*self.local_fields()
+            prob = table[deltaE//4+2]
+            accept = sublattice & (self.rng.random(self.spins.shape, dtype=np.float32) < prob)
+
+            self.energy += int(deltaE[accept].sum(dtype=np.int64))
+            self.magnetization -= 2*int(self.spins[accept].sum(dtype=np.int64))
+            self.spins[accept] *= -1
+            flipped += int(np.count_nonzero(accept))
+
+        self.nsweeps += 1
+        self.notify(None)
+
+        return flipped
+
+    def bond_probability(self, temperature):
+        # Probability to bond two parallel neighbours in the
+        # Wolff and Swendsen-Wang cluster updates
+
+        if temperature <= 0:
+            return 1.0
+
+        return 1-exp(-2/temperature)
+
+    def neighbour_sites(self, sites):
+        # Flat indices of the up, down, left and right neighbours
+        # of the flat site indices, with periodic boundaries
+
+        N = self.size
+        i, j = np.divmod(sites, N)
+
+        return np.stack([((i-1)%N)*N+j, ((i+1)%N)*N+j, i*N+(j-1)%N, i*N+(j+1)%N], axis=-1)
+
+    def wolff(self, temperature=None):
+        # Wolff single cluster update. A cluster of parallel spins is
+        # grown from a random seed site, adding every bond with the
+        # probability 1-exp(-2/T), and the whole cluster is flipped.
+        # The cluster grows one frontier at a time. Returns its size.
+
+        if temperature is None:
+            temperature = self.temperature
+        p_add = self.bond_probability(temperature)
+
+        spins = self.spins.reshape(-1)
+        seed = int(self.rng.integers(self.nspins))
+        spin = spins[seed]
+
+        in_cluster = np.zeros(self.nspins, dtype=bool)
+        in_cluster[seed] = True
+        frontier = np.array([seed])
+
+        while len(frontier):
+            candidates = self.neighbour_sites(frontier).reshape(-1)
+            candidates = candidates[(spins[candidates] == spin) & ~in_cluster[candidates]]
+            candidates = candidates[self.rng.random(len(candidates)) < p_add]
+            frontier = np.unique(candidates)
+            in_cluster[frontier] = True
+
+        spins[in_cluster] = -spin
+        nflipped = int(np.count_nonzero(in_cluster))
+
+        self.energy = self.total_energy()
+        self.magnetization -= 2*int(spin)*nflipped
+        self.notify(None)
+
+        return nflipped
+
+    def swendsen_wang(self, temperature=None):
+        # Swendsen-Wang update. Every bond of parallel neighbours is
+        # set with the probability 1-exp(-2/T), the clusters of the
+        # bonds are labelled with union-find, and every cluster is
+        # flipped with the probability 1/2. Returns the number of clusters.
+
+        if temperature is None:
+            temperature = self.temperature
+        p_add = self.bond_probability(temperature)
+
+        N = self.size
+        sites = np.arange(self.nspins).reshape(N, N)
+        spins = self.spins
+
+        # Bonds to the right and down neighbours
+        bonds_a = []
+        bonds_b = []
+        for axis in (0, 1):
+            bonded = (spins == np.roll(spins, -1, axis=axis)) & (self.rng.random((N, N)) < p_add)
+            bonds_a.append(sites[bonded])
+            bonds_b.append(np.roll(sites, -1, axis=axis)[bonded])
+
+        roots = union_find(self.nspins, np.concatenate(bonds_a), np.concatenate(bonds_b))
+
+        cluster_roots = np.flatnonzero(roots == np.arange(self.nspins))
+        flip_cluster = np.zeros(self.nspins, dtype=bool)
+        flip_cluster[cluster_roots] = self.rng.random(len(cluster_roots)) < 0.5
+
+        spins.reshape(-1)[flip_cluster[roots]] *= -1
+
+        self.reset_observables()
+
+        return len(cluster_roots)
+
+    def update(self, algorithm="sweep", temperature=None):
+        # One update with one of the algorithms: a single spin
+        # attempt, a checkerboard sweep, a Wolff cluster flip or
+        # a Swendsen-Wang update of the whole lattice
+
+        if algorithm == "single":
+            return self.step(temperature)
+        elif algorithm == "sweep":
+            return self.sweep(temperature)
+        elif algorithm == "wolff":
+            return self.wolff(temperature)
+        elif algorithm == "swendsen-wang":
+            return self.swendsen_wang(temperature)
+
+        raise ValueError(f"Unknown update algorithm: {algorithm}")
+
+    def reset_observables(self):
+        # Recomputes the energy and magnetization from the spins,
+        # needed after the spins array is modified directly
+
+        self.energy = self.total_energy()
+        self.magnetization = int(self.spins.sum(dtype=np.int64))
+
+        self.notify(None)
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def notify(self, site):
+        for observer in self.observers:
+            observer(self, site)
+
+
+def union_find(nsites, bonds_a, bonds_b):
+    # Vectorized union-find. The roots of the bonded sites are hooked
+    # onto the smaller of the two roots and the paths are compressed
+    # by pointer jumping until all the bonds lie inside one tree.
+    # Returns the root (the smallest site index) of every site.
+
+    parent = np.arange(nsites)
+
+    while True:
+        # Full path compression
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+        roots_a = parent[bonds_a]
+        roots_b = parent[bonds_b]
+        split = roots_a != roots_b
+        if not split.any():
+            return parent
+
+        lo = np.minimum(roots_a[split], roots_b[split])
+        hi = np.maximum(roots_a[split], roots_b[split])
+        np.minimum.at(parent, hi, lo)
+
+def autocorrelation(series):
+    # Normalized autocorrelation function of the series, using FFT
+
+    x = np.asarray(series, dtype=float)
+    x = x-x.mean()
+    n = len(x)
+
+    f = np.fft.rfft(x, 2*n)
+    acf = np.fft.irfft(f*np.conj(f))[:n]
+
+    if acf[0] == 0:
+        return np.zeros(n)
+
+    return acf/acf[0]
+
+def autocorrelation_time(series, c=5.0):
+    # Integrated autocorrelation time with the automatic window of
+    # Sokal: the sum is cut at the first window W >= c*tau(W).
+    # Measured in the units of the series, e.g. updates.
+
+    acf = autocorrelation(series)
+    if not acf.any():
+        return 0.5
+
+    tau = 2*np.cumsum(acf)-1
+    windows = np.arange(len(acf))
+    cut = np.flatnonzero(windows >= c*tau)
+    W = cut[0] if len(cut) else len(acf)-1
+
+    return float(tau[W]/2)
+
+def compare_algorithms(N=64, temperature=critical_temperature, nupdates=2000, nwarmup=200,
+                       algorithms=("sweep", "wolff", "swendsen-wang"), seed=None):
+    # Runs every algorithm from the same random lattice and reports
+    # the integrated autocorrelation time of |m| in updates, the time
+    # per update and the number of independent samples per CPU second,
+    # which is the effective speed of the algorithm.
+
+    import time
+
+    report = {}
+    for algorithm in algorithms:
+        lattice = IsingLattice(N, temperature=temperature, seed=seed)
+        for k in range(nwarmup):
+            lattice.update(algorithm)
+
+        series = np.empty(nupdates)
+        start = time.process_time()
+        for k in range(nupdates):
+            lattice.update(algorithm)
+            series[k] = abs(lattice.magnetization_density)
+        seconds = max(time.process_time()-start, 1e-9)
+
+        tau = autocorrelation_time(series)
+        report[algorithm] = {"tau": tau, "seconds_per_update": seconds/nupdates,
+                             "samples_per_second": nupdates/(2*tau)/seconds}
+
+    return report
@@ -0,0 +1,182 @@
+import numpy as np
+from math import exp
+
+# Multispin coded Ising lattice for very large systems. Every row of
+# the lattice is packed into uint64 words, 64 spins per word with the
+# bit 1 for the spin up, and the checkerboard Metropolis sweep is done
+# with bitwise logic on whole words. The memory is one bit per spin.
+#
+# The spin j of row i is the bit j%64 of the word (i, j//64), so the
+# left and right neighbours are the neighbouring bits and the up and
+# down neighbours are the same bits of the neighbouring rows.
+#
+# Example:
+#     lattice = PackedLattice(8192, temperature=2.27, seed=1)
+#     for i in range(100):
+#         lattice.sweep()
+#     print(lattice.magnetization_density)
+
+word_bits = 64
+
+one = np.uint64(1)
+last_bit = np.uint64(word_bits-1)
+
+# Bits of the even and odd sites of a row starting with an even site
+even_bits = np.uint64(0x5555555555555555)
+odd_bits = np.uint64(0xAAAAAAAAAAAAAAAA)
+
+def popcount(words):
+    # Number of set bits in all the words
+
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(words).sum(dtype=np.int64))
+
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+    return int(table[words.view(np.uint8)].sum())
+
+def pack_spins(spins):
+    # Packs a (N, N) array of spins +1/-1 into (N, N//64) words
+
+    bits = (np.asarray(spins) > 0).astype(np.uint8)
+
+    return np.packbits(bits, axis=1, bitorder="little").view("<u8").astype(np.uint64)
+
+def unpack_spins(words, N):
+    # Unpacks the words into a (N, N) int8 array of spins +1/-1
+
+    bits = np.unpackbits(words.astype("<u8").view(np.uint8), axis=1, bitorder="little")[:, :N]
+
+    return (2*bits.astype(np.int8)-1)
+
+
+class PackedLattice:
+
+    def __init__(self, N, temperature=1.0, seed=None, spins=None, precision=24):
+        # N x N lattice with N a multiple of 64. The acceptance
+        # probabilities are resolved to precision binary digits.
+
+        if N % word_bits:
+            raise ValueError(f"The lattice size should be a multiple of {word_bits}")
+
+        self.size = N
+        self.temperature = temperature
+        self.precision = precision
+        self.rng = np.random.default_rng(seed)
+
+        if spins is None:
+            self.words = self.random_words((N, N//word_bits))
+        else:
+            if np.shape(spins) != (N, N):
+                raise ValueError(f"The spins should have the shape {(N, N)}")
+            self.words = pack_spins(spins)
+
+        # Masks of the two sublattices of the checkerboard,
+        # (i+j) even and odd, for every row
+        rows = (np.arange(N) % 2 == 0)[:, None]
+        self.sublattices = (np.where(rows, even_bits, odd_bits), np.where(rows, odd_bits, even_bits))
+
+        self.nsweeps = 0
+        self.reset_observables()
+
+    def random_words(self, shape):
+        # Words of independent random bits
+
+        return self.rng.bit_generator.random_raw(shape).astype(np.uint64)
+
+    def random_bits(self, p, shape):
+        # Words of independent random bits that are set with the
+        # probability p, built from the binary digits of p with one
+        # random word per digit, from the last digit to the first
+
+        digits = int(round(p*2**self.precision))
+        if digits >= 2**self.precision:
+            return np.full(shape, ~np.uint64(0))
+
+        bits = np.zeros(shape, dtype=np.uint64)
+        for k in range(self.precision):
+            if digits >> k & 1:
+                bits |= self.random_words(shape)
+            else:
+                bits &= self.random_words(shape)
+
+        return bits
+
+    @property
+    def nspins(self):
+        return self.size*self.size
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    @property
+    def energy_density(self):
+        return self.energy/self.nspins
+
+    @property
+    def magnetization_density(self):
+        return self.magnetization/self.nspins
+
+    def right_neighbours(self):
+        # Words with the spin of the right neighbour in every bit
+
+        words = self.words
+        return (words >> one) | (np.roll(words, -1, axis=1) << last_bit)
+
+    def left_neighbours(self):
+        # Words with the spin of the left neighbour in every bit
+
+        words = self.words
+        return (words << one) | (np.roll(words, 1, axis=1) >> last_bit)
+
+    def reset_observables(self):
+        # Energy and magnetization from the bit counts of the spins
+        # and of the antiparallel bonds to the right and down neighbours
+
+        up = popcount(self.words)
+        antiparallel = (popcount(self.words ^ self.right_neighbours())
+                        +popcount(self.words ^ np.roll(self.words, -1, axis=0)))
+
+        self.magnetization = 2*up-self.nspins
+        self.energy = -(2*self.nspins-2*antiparallel)
+
+    def spins(self):
+        # The lattice as a (N, N) int8 array of spins +1/-1
+
+        return unpack_spins(self.words, self.size)
+
+    def sweep(self, temperature=None):
+        # One checkerboard Metropolis sweep with bitwise logic. With k
+        # antiparallel neighbours the energy change of a flip is 8-4k,
+        # so the flips with k >= 2 are always accepted, those with k = 1
+        # with the probability exp(-4/T) and those with k = 0 with
+        # exp(-8/T), which is the product of two independent exp(-4/T).
+
+        if temperature is None:
+            temperature = self.temperature
+
+        p4 = exp(-4/temperature) if temperature > 0 else 0.0
+        shape = self.words.shape
+
+        for sublattice in self.sublattices:
+            words = self.words
+            a1 = words ^ np.roll(words, 1, axis=0)
+            a2 = words ^ np.roll(words, -1, axis=0)
+            a3 = words ^ self.left_neighbours()
+            a4 = words ^ self.right_neighbours()
+
+            # Bitwise counts of the antiparallel neighbours
+            s1, c1 = a1 ^ a2, a1 & a2
+            s2, c2 = a3 ^ a4, a3 & a4
+            at_least_two = c1 | c2 | (s1 & s2)
+            none = ~(s1 | s2 | c1 | c2)
+
+            r1 = self.random_bits(p4, shape)
+            r2 = self.random_bits(p4, shape)
+            flip = at_least_two | (r1 & ~none) | (r1 & r2 & none)
+
+            self.words ^= flip & sublattice
+
+        self.nsweeps += 1
+        self.reset_observables()
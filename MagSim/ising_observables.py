@@ -0,0 +1,161 @@
+from math import sqrt
+
+# Streaming statistics of the Ising observables. Every observable
+# keeps Welford running moments of its samples and of the block
+# averages of 2, 4, 8, ... samples, so that the error of the mean
+# and the integrated autocorrelation time follow from the blocking
+# analysis without storing the samples. The memory does not depend
+# on the length of the run.
+#
+# Example:
+#     observables = Observables()
+#     for i in range(10000):
+#         lattice.sweep()
+#         observables.add(lattice)
+#     print(observables.summary(lattice.temperature, lattice.nspins))
+
+class Moments:
+
+    def __init__(self):
+        # Welford running mean and sum of squared deviations
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x-self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(x-self.mean)
+
+    @property
+    def variance(self):
+        return self.m2/(self.n-1) if self.n > 1 else 0.0
+
+    @property
+    def error(self):
+        # Error of the mean for independent samples
+        return sqrt(self.variance/self.n) if self.n > 1 else 0.0
+
+class BlockingStats:
+
+    def __init__(self, nlevels=40, min_blocks=32):
+        # The level k keeps the moments of the averages of blocks
+        # of 2**k samples, up to 2**nlevels samples in total. The
+        # error is read from the highest level with min_blocks blocks.
+
+        self.nlevels = nlevels
+        self.min_blocks = min_blocks
+        self.reset()
+
+    def reset(self):
+        self.levels = [Moments() for k in range(self.nlevels)]
+        # Unpaired block average waiting at every level
+        self.pending = [None]*self.nlevels
+
+    def add(self, x):
+        for k in range(self.nlevels):
+            self.levels[k].add(x)
+            if self.pending[k] is None:
+                self.pending[k] = x
+                return
+            x = (self.pending[k]+x)/2
+            self.pending[k] = None
+
+    @property
+    def n(self):
+        return self.levels[0].n
+
+    @property
+    def mean(self):
+        return self.levels[0].mean
+
+    @property
+    def variance(self):
+        return self.levels[0].variance
+
+    def level_errors(self):
+        # Error of the mean estimated at every level with enough blocks
+
+        return [level.error for level in self.levels if level.n >= self.min_blocks]
+
+    @property
+    def error(self):
+        # Blocking estimate of the error of the mean. The block
+        # averages become independent at the high levels, where the
+        # estimates reach a plateau.
+
+        errors = self.level_errors()
+        if not errors:
+            return self.levels[0].error
+
+        return errors[-1]
+
+    @property
+    def autocorrelation_time(self):
+        # Integrated autocorrelation time in samples, from the ratio
+        # of the blocking error and the naive error
+
+        naive = self.levels[0].error
+        if naive == 0:
+            return 0.5
+
+        return 0.5*(self.error/naive)**2
+
+class Observables:
+
+    # Observables per spin accumulated from the lattice
+    names = ("energy", "abs_magnetization", "magnetization2", "magnetization4")
+
+    def __init__(self, nlevels=40, min_blocks=32):
+        self.stats = {name: BlockingStats(nlevels=nlevels, min_blocks=min_blocks) for name in self.names}
+
+    def reset(self):
+        for stats in self.stats.values():
+            stats.reset()
+
+    def add(self, lattice):
+        # Adds a sample of the lattice, either engine or the
+        # bit-packed lattice, or a snapshot with the same attributes
+        self.add_sample(lattice.energy_density, lattice.magnetization_density)
+
+    def add_sample(self, energy, magnetization):
+        m2 = magnetization*magnetization
+
+        self.stats["energy"].add(energy)
+        self.stats["abs_magnetization"].add(abs(magnetization))
+        self.stats["magnetization2"].add(m2)
+        self.stats["magnetization4"].add(m2*m2)
+
+    def __getitem__(self, name):
+        return self.stats[name]
+
+    @property
+    def n(self):
+        return self.stats["energy"].n
+
+    def summary(self, temperature, nspins):
+        # Means with the blocking errors and autocorrelation times,
+        # and the specific heat, susceptibility and Binder cumulant
+
+        energy = self.stats["energy"]
+        abs_m = self.stats["abs_magnetization"]
+        m2 = self.stats["magnetization2"].mean
+        m4 = self.stats["magnetization4"].mean
+
+        # The variance of the moments uses n, as for the population
+        n = max(energy.n, 1)
+        var_e = energy.variance*(n-1)/n
+        var_m = m2-abs_m.mean**2
+
+        return {"n": energy.n,
+                "energy": energy.mean, "energy_error": energy.error,
+                "energy_tau": energy.autocorrelation_time,
+                "abs_magnetization": abs_m.mean, "abs_magnetization_error": abs_m.error,
+                "abs_magnetization_tau": abs_m.autocorrelation_time,
+                "specific_heat": nspins*var_e/temperature**2 if temperature > 0 else 0.0,
+                "susceptibility": nspins*var_m/temperature if temperature > 0 else 0.0,
+                "binder": 1-m4/(3*m2*m2) if m2 > 0 else 0.0}
@@ -0,0 +1,116 @@
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from ising_engine import IsingLattice
+from ising_multispin import PackedLattice
+from ising_observables import Observables
+
+# Temperature sweeps for the phase diagram and finite size scaling.
+# Every point (size, temperature, seed) is an independent run in a
+# process pool with warmup sweeps followed by measurement sweeps,
+# and the averages of every point are written as columns of a .npz
+# file, one entry per point.
+#
+# Example:
+#     python ising_sweep.py --sizes 16 32 64 --tmin 1.8 --tmax 3.0 --ntemps 25 \
+#         --seeds 1 2 3 --output sweep.npz
+
+# Update algorithms of the sweep, multispin uses the bit-packed
+# lattice which needs sizes that are multiples of 64
+sweep_algorithms = ("sweep", "wolff", "swendsen-wang", "multispin")
+
+# Columns of the output file
+columns = ("size", "temperature", "seed", "abs_magnetization", "energy",
+           "specific_heat", "susceptibility", "binder",
+           "abs_magnetization_error", "energy_error", "abs_magnetization_tau")
+
+def new_lattice(N, temperature, seed, algorithm):
+    if algorithm == "multispin":
+        return PackedLattice(N, temperature=temperature, seed=seed)
+    return IsingLattice(N, temperature=temperature, seed=seed)
+
+def update(lattice, algorithm):
+    if algorithm == "multispin":
+        lattice.sweep()
+    else:
+        lattice.update(algorithm)
+
+def run_point(N, temperature, seed, nwarmup=1000, nmeasure=5000, algorithm="sweep"):
+    # Runs one point of the sweep and returns its row of the columns.
+    # The specific heat and the susceptibility are per spin and the
+    # susceptibility uses |m|, as usual for finite lattices. The errors
+    # and the autocorrelation time come from the blocking analysis.
+
+    lattice = new_lattice(N, temperature, seed, algorithm)
+
+    for k in range(nwarmup):
+        update(lattice, algorithm)
+
+    observables = Observables()
+    for k in range(nmeasure):
+        update(lattice, algorithm)
+        observables.add(lattice)
+
+    row = observables.summary(temperature, N*N)
+    row.update(size=N, temperature=temperature, seed=seed)
+
+    return row
+
+def run_sweep(sizes, temperatures, seeds=(0,), nwarmup=1000, nmeasure=5000, algorithm="sweep",
+              workers=None, output=None):
+    # Runs all the combinations of sizes, temperatures and seeds in a
+    # process pool (serially with workers=0). Returns the dictionary of
+    # columns, which is also written to the output .npz file if given.
+
+    if algorithm not in sweep_algorithms:
+        raise ValueError(f"Unknown update algorithm: {algorithm}")
+
+    points = list(itertools.product(sizes, temperatures, seeds))
+    args = [list(arg) for arg in zip(*points)]
+    n = len(points)
+
+    if workers == 0:
+        rows = list(map(run_point, *args, [nwarmup]*n, [nmeasure]*n, [algorithm]*n))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(run_point, *args, [nwarmup]*n, [nmeasure]*n, [algorithm]*n))
+
+    results = {column: np.array([row[column] for row in rows]) for column in columns}
+
+    if output is not None:
+        np.savez_compressed(output, algorithm=algorithm, nwarmup=nwarmup, nmeasure=nmeasure, **results)
+
+    return results
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Sweep the Ising model over temperatures and sizes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 32])
+    parser.add_argument("--temperatures", type=float, nargs="+", default=None,
+                        help="temperatures, or use --tmin, --tmax and --ntemps")
+    parser.add_argument("--tmin", type=float, default=1.5)
+    parser.add_argument("--tmax", type=float, default=3.5)
+    parser.add_argument("--ntemps", type=int, default=21)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--nwarmup", type=int, default=1000)
+    parser.add_argument("--nmeasure", type=int, default=5000)
+    parser.add_argument("--algorithm", choices=sweep_algorithms, default="sweep")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="ising_sweep.npz")
+    args = parser.parse_args(argv)
+
+    temperatures = args.temperatures
+    if temperatures is None:
+        temperatures = np.linspace(args.tmin, args.tmax, args.ntemps)
+
+    results = run_sweep(args.sizes, temperatures, seeds=args.seeds, nwarmup=args.nwarmup,
+                        nmeasure=args.nmeasure, algorithm=args.algorithm, workers=args.workers,
+                        output=args.output)
+
+    for row in zip(*(results[column] for column in columns)):
+        print("N={:<5d} T={:.4f} seed={:<4d} |m|={:.4f} e={:.4f} C={:.4f} chi={:.4f} U={:.4f}".format(*row))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import time
+import queue
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+from ising_engine import IsingLattice, algorithms
+
+# Runs the Ising simulation in a background process. The worker
+# publishes snapshots of the lattice and the observables through a
+# double buffer in shared memory: it writes the back buffer and then
+# flips the index of the front buffer, so the reader never waits for
+# a lock. Every buffer has its own sequence number, which is odd while
+# the buffer is being written, as in a seqlock, and the reader copies
+# the buffer again if the number was odd or changed during the copy.
+# Changes of the temperature or the algorithm are sent to the worker
+# as commands.
+#
+# Example:
+#     worker = SimulationWorker(256, temperature=2.27, algorithm="sweep")
+#     worker.send("temperature", 2.0)
+#     spins, energy, magnetization, nupdates, sequence = worker.snapshot()
+#     worker.close()
+
+# Control words of the channel: the sequence number, incremented on
+# every publish, the index of the front buffer and the sequence
+# numbers of the two buffers, odd while the buffer is written
+SEQUENCE, FRONT, BUFFER_SEQUENCE = 0, 1, 2
+
+# Observables of every buffer, with the sequence number of the
+# publish that wrote the buffer
+ENERGY, MAGNETIZATION, NUPDATES, PUBLISHED = 0, 1, 2, 3
+
+class SnapshotChannel:
+
+    def __init__(self, N, name=None):
+        # Shared memory with two spin buffers, their observables and
+        # the control words. A new block is created without a name.
+
+        self.size = N
+        nbytes = 4*8+2*4*8+2*N*N
+        self.owner = name is None
+
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        buf = self.shm.buf
+        self.control = np.ndarray(4, dtype=np.int64, buffer=buf, offset=0)
+        self.observables = np.ndarray((2, 4), dtype=np.int64, buffer=buf, offset=32)
+        self.spins = np.ndarray((2, N, N), dtype=np.int8, buffer=buf, offset=96)
+
+        if self.owner:
+            self.control[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def publish(self, lattice, nupdates):
+        # Writes the lattice to the back buffer and makes it the front
+
+        back = 1-int(self.control[FRONT])
+        sequence = int(self.control[SEQUENCE])+1
+
+        self.control[BUFFER_SEQUENCE+back] += 1
+        self.spins[back] = lattice.spins
+        self.observables[back] = (lattice.energy, lattice.magnetization, nupdates, sequence)
+        self.control[BUFFER_SEQUENCE+back] += 1
+
+        self.control[FRONT] = back
+        self.control[SEQUENCE] = sequence
+
+    def read(self):
+        # Copies the front buffer. If the worker was writing the buffer
+        # before or during the copy, the copy may be torn, then read again.
+        # Returns (spins, energy, magnetization, nupdates, sequence),
+        # where sequence is the number of the publish that was copied.
+
+        while True:
+            front = int(self.control[FRONT])
+
+            before = int(self.control[BUFFER_SEQUENCE+front])
+            if before % 2:
+                continue
+            spins = self.spins[front].copy()
+            energy, magnetization, nupdates, sequence = (int(x) for x in self.observables[front])
+            after = int(self.control[BUFFER_SEQUENCE+front])
+
+            if before == after:
+                return spins, energy, magnetization, nupdates, sequence
+
+    def close(self):
+        del self.control, self.observables, self.spins
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def run_worker(name, N, temperature, algorithm, seed, commands, publish_interval):
+    # Body of the worker process. Runs the updates as fast as it
+    # can and publishes a snapshot every publish_interval seconds.
+    # Commands are tuples (command, *arguments).
+
+    channel = SnapshotChannel(N, name=name)
+    lattice = IsingLattice(N, temperature=temperature, seed=seed)
+
+    running = True
+    nupdates = 0
+    channel.publish(lattice, nupdates)
+    last_publish = time.perf_counter()
+
+    try:
+        while True:
+            # Apply all pending commands, block while paused
+            try:
+                while True:
+                    command, *args = commands.get(block=not running)
+                    if command == "stop":
+                        return
+                    elif command == "temperature":
+                        lattice.temperature = args[0]
+                    elif command == "algorithm":
+                        algorithm = args[0]
+                    elif command == "flip":
+                        lattice.flip(*args)
+                        channel.publish(lattice, nupdates)
+                    elif command == "pause":
+                        running = False
+                    elif command == "play":
+                        running = True
+            except queue.Empty:
+                pass
+
+            if not running:
+                continue
+
+            lattice.update(algorithm)
+            nupdates += 1
+
+            now = time.perf_counter()
+            if now-last_publish >= publish_interval:
+                channel.publish(lattice, nupdates)
+                last_publish = now
+    finally:
+        channel.close()
+
+class SimulationWorker:
+
+    def __init__(self, N, temperature=1.0, algorithm="sweep", seed=None, publish_interval=1/60):
+        # Starts the worker process on a new random lattice
+
+        if algorithm not in algorithms:
+            raise ValueError(f"Unknown update algorithm: {algorithm}")
+
+        self.size = N
+        self.channel = SnapshotChannel(N)
+        self.commands = mp.Queue()
+        self.process = mp.Process(target=run_worker, daemon=True,
+                                  args=(self.channel.name, N, temperature, algorithm, seed,
+                                        self.commands, publish_interval))
+        self.process.start()
+
+    def send(self, command, *args):
+        # Sends a command: ("temperature", T), ("algorithm", name),
+        # ("flip", i, j), ("pause",) or ("play",)
+        self.commands.put((command, *args))
+
+    def snapshot(self):
+        # The latest published (spins, energy, magnetization, nupdates,
+        # sequence), the sequence tells apart the snapshots
+        return self.channel.read()
+
+    @property
+    def sequence(self):
+        return int(self.channel.control[SEQUENCE])
+
+    def close(self, timeout=5):
+        # Stops the worker and frees the shared memory
+
+        if self.process.is_alive():
+            self.send("stop")
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+
+        self.channel.close()